@@ -0,0 +1,257 @@
+"""Offline micro-benchmarks for the ciphers in xor.py.
+
+Besides sweeping sxor, cipher and rcipher over input sizes and key lengths,
+single .index fields are decrypted the way EncryptedFile did before it kept
+a prepared xor.Key (deciphering the obfuscated password on every call) and
+the way it does now, to show the per-field read overhead. Reading a file
+through EncryptedFile is timed with every backend in xor.BACKENDS; the null
+backend gives the cost of the I/O alone. Loaded .index entries are held as
+a tuple of FindTopic objects and as an EntryStore, to compare their memory.
+
+Every benchmark is timed with timeit and run once more in a forked child
+to record how much its peak resident memory grew, which stands in for
+allocation tracking. Results can be saved as a baseline and later runs
+compared against it:
+
+  python benchmark.py --save baseline.json
+  python benchmark.py --baseline baseline.json --threshold 0.2
+
+The second run exits with status 1 if any benchmark lost more than the
+threshold (a fraction) of its baseline throughput.
+
+"""
+import argparse
+import json
+import os
+import resource
+import sys
+import tempfile
+import timeit
+from random import randint
+
+import xor
+from file_controller import EncryptedFile, EntryStore, FindTopic, Index
+
+#Sizes from an .index offset field up to the largest .corpora offset.
+SIZES = (6, 32, 44, 4096, 1 << 16, 1 << 20, 1 << 24)
+KEY_LENGTHS = (4, 16, 64, 256)
+#Bytes each timing run should push through, so small sizes repeat, and
+#the most calls it may take to do so.
+BUDGET = 1 << 20
+MAX_CALLS = 2000
+REPEAT = 3
+THRESHOLD = 0.25
+#.index field widths and the password length used for per-field reads.
+FIELDS = (32, 6)
+PASSWORD_LENGTH = 16
+#Size of the file read through every backend, and of each write to it.
+FILE_SIZE = 1 << 20
+RECORD = 44
+#Number of .index entries held in memory.
+ENTRIES = 1 << 20
+
+def _random(n):
+  """Return a random string of n bytes."""
+
+  return "".join(chr(randint(0, 255)) for _ in xrange(n))
+
+def _rstream(txt, key):
+  """Run txt through rcipher_stream() in key sized chunks.
+
+  Only chunks as long as the key always line up with it, so any shorter
+  tail of txt is left out.
+
+  """
+  z = len(key)
+  return "".join(xor.rcipher_stream((txt[i:i+z] \
+    for i in xrange(0, len(txt) - z + 1, z)), key))
+
+def _fieldBefore(field, key):
+  """Decrypt a field the way EncryptedFile did before xor.Key.
+
+  The obfuscated password was deciphered with the access key on every
+  read, then used to decipher the field.
+
+  """
+  return xor.cipher(field, xor.cipher(key._key, key._access))
+
+#(name, function, smallest size relative to the key length)
+BENCHMARKS = (
+  ("sxor", xor.sxor, 0),
+  ("cipher", xor.cipher, 0),
+  ("rcipher", _rstream, 1),
+)
+
+def peakGrowth(func):
+  """Return how many kilobytes the peak resident size grows running func.
+
+  func is run in a forked child so earlier benchmarks don't hide its peak.
+
+  """
+  r, w = os.pipe()
+  pid = os.fork()
+  if pid == 0:
+    os.close(r)
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    func()
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    os.write(w, str(after - before))
+    os._exit(0)
+  os.close(w)
+  growth = int(os.read(r, 64) or 0)
+  os.close(r)
+  os.waitpid(pid, 0)
+  return growth
+
+def measure(name, func, args, size):
+  """Time func(*args) and return a result dictionary for it."""
+
+  number = max(1, min(BUDGET // size, MAX_CALLS))
+  t = timeit.Timer(lambda: func(*args))
+  best = min(t.repeat(REPEAT, number)) / number
+  return {"name": name, "size": size, "MBps": size / best / (1 << 20),
+    "usPerCall": best * 1e6, "peakKB": peakGrowth(lambda: func(*args))}
+
+def run(sizes=SIZES, keyLengths=KEY_LENGTHS, out=sys.stdout):
+  """Run every benchmark over every size and key length.
+
+  Return a dictionary mapping benchmark ids to result dictionaries.
+
+  """
+  results = {}
+  for size in sizes:
+    txt = _random(size)
+    for z in keyLengths:
+      key = _random(z)
+      for name, func, fits in BENCHMARKS:
+        if size < fits * z:
+          continue
+        r = measure(name, func, (txt, key), size)
+        r["key"] = z
+        results["{0}/{1}/{2}".format(name, size, z)] = r
+        report(r, out)
+  return results
+
+def fieldReads(out=sys.stdout):
+  """Time decrypting single .index fields before and after xor.Key.
+
+  Return a dictionary mapping benchmark ids to result dictionaries.
+
+  """
+  results = {}
+  key = xor.Key(_random(PASSWORD_LENGTH))
+  for size in FIELDS:
+    field = _random(size)
+    for name, func in (("field-before", _fieldBefore),
+        ("field-after", xor.cipher)):
+      r = measure(name, func, (field, key), size)
+      r["key"] = PASSWORD_LENGTH
+      results["{0}/{1}".format(name, size)] = r
+      report(r, out)
+  return results
+
+def fileReads(out=sys.stdout):
+  """Time reading a file back through EncryptedFile with every backend.
+
+  The file is written in RECORD sized writes and read back the same way,
+  since not every backend allows reads of other sizes. Return a dictionary
+  mapping benchmark ids to result dictionaries.
+
+  """
+  results = {}
+  records = [_random(RECORD) for _ in xrange(FILE_SIZE // RECORD)]
+  fd, path = tempfile.mkstemp()
+  os.close(fd)
+  try:
+    for version in sorted(xor.BACKENDS):
+      name = xor.BACKENDS[version].NAME
+      f = EncryptedFile(path, _random(PASSWORD_LENGTH), "w+", version)
+      for r in records:
+        f.write(r)
+      def readBack():
+        f.seek(0)
+        for _ in records:
+          f.read(RECORD)
+      r = measure("file-" + name, readBack, (), RECORD * len(records))
+      r["key"] = PASSWORD_LENGTH
+      results["file-{0}/{1}".format(name, r["size"])] = r
+      report(r, out)
+      f.close()
+  finally:
+    os.remove(path)
+  return results
+
+def _entryTable(n):
+  """Return the decrypted bytes of n sorted .index entries."""
+
+  return "".join("{0:08x}".format(i) + FindTopic.NULL + _random(23) + \
+    "{0:06x}{1:06x}".format(i, i + 1) for i in xrange(n))
+
+def _entryTuple(table):
+  """Hold entries the way Index did before EntryStore."""
+
+  n, o = Index._NAME_LENGTH, Index._OFFSET_LENGTH
+  return tuple(FindTopic(table[i:i+n], table[i+n:i+n+o], \
+    table[i+n+o:i+Index._ENTRY_LENGTH]) \
+    for i in xrange(0, len(table), Index._ENTRY_LENGTH))
+
+def entryStores(n=ENTRIES, out=sys.stdout):
+  """Time and measure holding n loaded entries as FindTopics and EntryStore.
+
+  Return a dictionary mapping benchmark ids to result dictionaries.
+
+  """
+  results = {}
+  table = _entryTable(n)
+  for name, func in (("entries-tuple", _entryTuple),
+      ("entries-store", EntryStore.fromTable)):
+    r = measure(name, func, (table,), n * Index._ENTRY_LENGTH)
+    results["{0}/{1}".format(name, n)] = r
+    report(r, out)
+  return results
+
+def report(result, out=sys.stdout):
+  """Write a single result as one line of a table."""
+
+  out.write("{0:<12} {1:>10} B  key {2:>3}  {3:>10.2f} MB/s  {4:>10.2f} us"\
+    "  {5:>8} KB peak\n".format(result["name"], result["size"],
+    result.get("key", "-"), result["MBps"], result["usPerCall"],
+    result["peakKB"]))
+
+def regressions(results, baseline, threshold=THRESHOLD):
+  """Return the ids of results slower than baseline by more than threshold."""
+
+  return sorted(i for i in results if i in baseline and \
+    results[i]["MBps"] < baseline[i]["MBps"] * (1 - threshold))
+
+def main(argv=None):
+  """Parse command line arguments, benchmark and compare to a baseline."""
+
+  parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+  parser.add_argument("--save", help="write results to this JSON file")
+  parser.add_argument("--baseline", help="JSON file to compare results to")
+  parser.add_argument("--threshold", type=float, default=THRESHOLD,
+    help="tolerated fractional throughput loss (default %(default)s)")
+  parser.add_argument("--max-size", type=int, default=SIZES[-1],
+    help="skip input sizes above this many bytes")
+  parser.add_argument("--entries", type=int, default=ENTRIES,
+    help="number of .index entries to hold (default %(default)s)")
+  args = parser.parse_args(argv)
+
+  results = run([s for s in SIZES if s <= args.max_size])
+  results.update(fieldReads())
+  results.update(fileReads())
+  results.update(entryStores(args.entries))
+  if args.save:
+    with open(args.save, "w") as f:
+      json.dump(results, f, indent=1, sort_keys=True)
+  if args.baseline:
+    with open(args.baseline) as f:
+      slow = regressions(results, json.load(f), args.threshold)
+    for i in slow:
+      sys.stdout.write("REGRESSION {0}\n".format(i))
+    return 1 if slow else 0
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main())
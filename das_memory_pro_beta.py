@@ -1,6 +1,5 @@
 import curses
 import curses.textpad
-import re
 import priority_queue
 import file_controller
 
@@ -222,8 +221,6 @@ class SearchMenu(Menu):
 
   Member Variables:
     env reference to the Environment instance for the session.
-    topics reference to the topics stored in the Index object.
-      This is to reduce the length of the name of the variable.
     searchResults python list containing FindTopic objects related to what the
       user has recently searched.
     selectCursor currently selected index in the searchResults list.
@@ -260,7 +257,6 @@ class SearchMenu(Menu):
     """
     Menu.__init__(self)
     self.env = env
-    self.topics = env.index.entries
     self.searchResults = []
     self.selectCursor = -1
     self.bindings["i"] = self.INSERT
@@ -403,35 +399,14 @@ class SearchMenu(Menu):
     self.HelpWindow.clear()
     self.HelpWindow.refresh()
 
-  def search(self, query, left=0, right=-1):
-    """Conduct binary search on self.topics and populate searchResults.""" 
-
-    if right == -1:
-      right = len(self.topics)
-    if left >= right or len(query) == 0:
-      self.searchResults = []
-      return
-
-    mid = (left+right)//2
-    #First match: do some more searching
-    if re.match(query, self.topics[mid].name):
-      self.searchResults.append(self.topics[mid])
-      #linearly search up from the match
-      for i in xrange(mid-1,0,-1):
-        if re.match(query, self.topics[i].name):
-          self.searchResults.append(self.topics[i])
-        else:
-          break
-      #linearly search down from the match
-      for i in xrange(mid+1,len(self.topics)):
-        if re.match(query, self.topics[i].name):
-          self.searchResults.append(self.topics[i])
-        else:
-          break
-    elif query > self.topics[mid].name:
-      self.search(query, mid+1, right)
-    else:
-      self.search(query, left, mid)
+  def search(self, query):
+    """Populate searchResults with the topics whose names start with query.
+
+    The .index file is binary searched, so only the matching entries and
+    O(log n) names are read and decrypted.
+
+    """
+    self.searchResults = self.env.index.prefixRange(query) if query else []
 
 class CreateMenu(Menu):
   """CreateMenu defines a Menu at which NewTopics can be created.
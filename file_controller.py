@@ -1,4 +1,18 @@
+import atexit
+import bisect
+import getpass
+import heapq
+import io
+import mmap
+import os
+import sys
+import threading
+import time
 import xor
+from array import array
+from binascii import unhexlify
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 from random import randint
 
 class Index(object):
@@ -9,20 +23,47 @@ class Index(object):
   so that other functions don't need to know this information. All data that 
   comes out of Index are FindTopics rather than raw bytes.
 
+  The index is log-structured: once .index holds entries, insertEntries()
+  writes new entries to a small, sorted delta segment of their own (.index.1,
+  .index.2 and so on) instead of rewriting .index, and reads merge .index
+  and its segments on the fly. When there are more than _MAX_SEGMENTS
+  segments, or they hold more than _SEGMENT_RATIO of the entries of .index,
+  compact() merges them into .index in a background thread.
+
   Class Variables:
     _NAME_LENGTH the size(in bytes) of a name of an entry in an .index file.
     _OFFSET_LENGTH the size/width of the numerical byte offset for a topic.
     _END_BYTE_LENGTH the width of the numerical ending byte for a topic.
     _ENTRY_LENGTH the total size(in bytes) of an entry in an .index file.
+    _FIELDS the widths of the fields of an entry, in the order written.
+    _MAX_SEGMENTS the most delta segments kept before compacting.
+    _COMPACTING suffix of the file compact() writes the merged .index to.
+    _SEGMENT_RATIO the largest fraction of the number of entries in .index
+      the segments may hold before compacting.
     OFFSET_BASE the radix of the offset.
 
   Member Variables:
     _filestream the actual .index file-like object to read and write from.
       This object must support a reOpen() method.
-    _entries tuple containing all entries in .index.
+    _entries EntryStore containing all entries in .index.
       This has a value of None until the 'entries' field is accessed.
       When _write() is called, the entries are no longer accurate; _entries
       will then have a value of None.
+    _counts dictionary counting how many times the entries were loaded from
+      disk ('loads'), how many entries were loaded and how many written, and
+      how many times the segments were compacted.
+    _segments list of the Index of every delta segment, oldest first. An
+      Index of a segment has no segments itself. Segments are numbered in
+      the order they were written, with gaps where compact() removed some.
+    _segmented True if the Index keeps delta segments.
+    _compactor the Thread running compact() in the background, or None.
+    _retired dictionary of the counters of the files and segments compact()
+      closed, so that stats() still counts their I/O.
+    _lock RLock held by reads and writes, and by compact() while it reads
+      the entries and swaps in the merged file, so compact() can run in the
+      background.
+    _compaction Lock held for the whole of a compact(), so that only one
+      runs at a time.
 
   """
 
@@ -30,86 +71,327 @@ class Index(object):
   _OFFSET_LENGTH = 6
   _END_BYTE_LENGTH = 6
   _ENTRY_LENGTH = _NAME_LENGTH + _OFFSET_LENGTH + _END_BYTE_LENGTH
+  _FIELDS = (_NAME_LENGTH, _OFFSET_LENGTH, _END_BYTE_LENGTH)
+  _MAX_SEGMENTS = 8
+  _COMPACTING = ".compacting"
+  _SEGMENT_RATIO = 0.25
   OFFSET_BASE = 16
 
-  def __init__(self, filestream):
-    """Initialize an Index object given an extended file object."""
+  def __init__(self, filestream, segmented=True):
+    """Initialize an Index object given an extended file object.
+
+    Unless segmented is False, the delta segments already written next to
+    the file are opened as well.
 
+    """
     self._filestream  = filestream
     self._entries = None
+    self._counts = {"loads": 0, "entriesLoaded": 0, "entriesWritten": 0,
+      "compactions": 0}
+    self._segmented = segmented
+    self._segments = []
+    self._compactor = None
+    self._retired = {}
+    self._lock = threading.RLock()
+    self._compaction = threading.Lock()
+    for n in self._segmentNumbers() if segmented else []:
+      self._segments.append(Index(filestream.sibling(self._segmentName(n),
+        "r+"), False))
+
+  def _segmentName(self, n):
+    """Return the file name of the n-th delta segment."""
+
+    return "{0}.{1}".format(self._filestream.name, n)
+
+  def _segmentNumbers(self):
+    """Return the sorted numbers of the delta segments found on disk."""
+
+    directory, base = os.path.split(self._filestream.name)
+    numbers = []
+    for n in os.listdir(directory or "."):
+      number = n[len(base) + 1:]
+      if n.startswith(base + ".") and number.isdigit():
+        numbers.append(int(number))
+    return sorted(numbers)
+
+  def segmentNames(self):
+    """Return the file names of the delta segments, oldest first."""
+
+    with self._lock:
+      return [s._filestream.name for s in self._segments]
+
+  def files(self):
+    """Return the names of every file the Index is stored in."""
+
+    return [self._filestream.name] + self.segmentNames()
 
   def _setWrite(self):
-    """Reopen the internal file object for write mode.
+    """Switch the internal file object to write mode, truncating it.
     
-    If _filestream is already opened in 'w' mode, nothing happens.
+    If _filestream is already in 'w' mode, nothing happens. A filestream
+    opened for reading and writing is truncated in place, not reopened.
     
     """
     self._filestream = self._filestream.reOpen("w")
 
   def _setRead(self):
-    """Reopen the internal file object for read mode and flush the I/O buffer.
+    """Switch the internal file object to read mode and flush the I/O buffer.
     
-    If _filestream is already opened in 'r' mode, nothing happens.
+    If _filestream is already in 'r' mode, nothing happens.
 
     """
     self._filestream = self._filestream.reOpen("r")
 
   def close(self):
-    """Close and Flush the internal filestream of the Index."""
+    """Close and Flush the internal filestream of the Index.
+
+    A compact() running in the background is waited for first.
 
+    """
+    compactor = self._compactor
+    if compactor is not None:
+      compactor.join()
+    for segment in self._segments:
+      segment.close()
     self._filestream.close()
 
+  def stats(self):
+    """Return the counters of the Index merged with those of its file.
+
+    The counters of the delta segments, and of the files compact() has
+    replaced, are added in.
+
+    """
+    with self._lock:
+      stats = dict(self._filestream.stats(), **self._counts)
+      for segment in self._segments:
+        self._addCounts(stats, segment.stats())
+      self._addCounts(stats, self._retired)
+      stats["segments"] = len(self._segments)
+      return stats
+
+  @staticmethod
+  def _addCounts(total, counts):
+    """Add every counter in counts but 'segments' to those in total."""
+
+    for name, count in counts.iteritems():
+      if name != "segments":
+        total[name] = total.get(name, 0) + count
+
   @property
   def entries(self):
     """Lazily load all entries in the .index file into memory.
 
-    Return a sorted tuple of FindTopic objects.
+    Return a sorted EntryStore, a sequence of FindTopic objects, of the
+    entries of .index and of all its segments. Entries are sorted by their
+    padded names, so entries with equal human readable names come in the
+    random order of their padding, not in the order they were written.
     """
 
-    if not self._entries:
-      self._entries = tuple(self._allEntries())
-    return self._entries
+    with self._lock:
+      if not self._entries:
+        stores = [s.entries for s in reversed(self._segments)]
+        stores.append(EntryStore.fromTable(self._allEntries()))
+        self._entries = EntryStore.merge(stores) if len(stores) > 1 \
+          else stores[0]
+        self._counts["loads"] += 1
+        self._counts["entriesLoaded"] += len(self._entries)
+      return self._entries
+
+  def __len__(self):
+    """Return the number of entries in the .index file and its segments."""
+
+    with self._lock:
+      if self._entries is not None:
+        return len(self._entries)
+      return self._fileLength() + sum(len(s) for s in self._segments)
+
+  def _fileLength(self):
+    """Return the number of entries _name() and _range() index."""
+
+    if self._entries is not None:
+      return len(self._entries)
+    self._setRead()
+    return self._filestream.size() // self._ENTRY_LENGTH
 
-  def _nextEntry(self):
-    """Return the next entry in the index file.
+  def _name(self, i):
+    """Return the raw name of the i-th entry.
 
-    Read from the .index file and return a FindTopic object representing the 
-    next topic entry in the .index file. If there are no more entries within 
-    the .index file, return None.
+    Only that name is read and decrypted, unless the entries are loaded.
+    Until they are, only the entries of .index itself are indexed.
 
     """
-    self._setRead()
-    name = self._filestream.read(self._NAME_LENGTH)
-    offset = self._filestream.read(self._OFFSET_LENGTH)
-    endset = self._filestream.read(self._END_BYTE_LENGTH)
-    if name and offset and endset:
-      return FindTopic(name, offset, endset)
+    if self._entries is not None:
+      return self._entries.name(i)
+    return self._filestream.pread(i * self._ENTRY_LENGTH, self._NAME_LENGTH)
+
+  def _bisect(self, past):
+    """Return the first i for which past(name of the i-th entry) is True.
+
+    past must be False for every entry before that one and True for every
+    entry after it, which holds for any ordering of the names since the
+    entries are sorted by name. Only O(log n) names are decrypted.
+
+    """
+    left, right = 0, self._fileLength()
+    while left < right:
+      mid = (left + right) // 2
+      if past(self._name(mid)):
+        right = mid
+      else:
+        left = mid + 1
+    return left
+
+  def _range(self, start, end):
+    """Return a list of FindTopics for the entries [start:end)."""
+
+    if self._entries is not None:
+      return self._entries[start:end]
+    if start >= end:
+      return []
+    self._filestream.seek(start * self._ENTRY_LENGTH)
+    fields = self._filestream.readRecords(self._FIELDS, end - start)
+    return [FindTopic(*fields[i:i+len(self._FIELDS)]) \
+      for i in xrange(0, len(fields), len(self._FIELDS))]
+
+  def lookup(self, name):
+    """Return the FindTopic of the entry with the given human readable name.
+
+    Return None if there is none. If there are several, which one is
+    returned depends on their random padding. The .index file and its
+    segments are binary searched, so the entries don't need to be loaded.
+
+    """
+    with self._lock:
+      if self._entries is None:
+        for segment in reversed(self._segments):
+          found = segment.lookup(name)
+          if found is not None:
+            return found
+      #Names are padded after a NULL, the smallest character, so the padded
+      #names of an entry sort right after name itself.
+      self._setRead()
+      i = self._bisect(lambda n: n >= name + FindTopic.NULL)
+      found = self._range(i, i + 1)
+      if found and found[0].cleanName() == name:
+        return found[0]
+
+  def prefixRange(self, prefix):
+    """Return a sorted list of the FindTopics whose names start with prefix.
+
+    The .index file and its segments are binary searched for the first and
+    last of them, so the entries don't need to be loaded.
+
+    """
+    with self._lock:
+      self._setRead()
+      start = self._bisect(lambda n: n >= prefix)
+      end = self._bisect(lambda n: n[:len(prefix)] > prefix)
+      found = self._range(start, end)
+      if self._entries is not None or not self._segments:
+        return found
+      ranges = [s.prefixRange(prefix) for s in reversed(self._segments)]
+      return mergeTopics(ranges + [found])
 
   def _allEntries(self):
-    """Yield a generator over all the entries in the .index file.
+    """Return the decrypted bytes of all the entries in the .index file.
     
-    _allEntries makes repreated calls to _nextEntry() and returns FindTopic
-    objects. The loop that yields data is conditional upon whether the next
-    FindTopic object evaluates to a False value(None as returned upon failure
-    of _nextEntry()). 
+    The whole file is read with a single readTable() of the filestream,
+    which decrypts every field of every entry in one pass.
 
     """
     #Seek to the beggining
+    self._setRead()
     self._filestream.seek(0)
-    tempEntry = self._nextEntry()
-    #This would be a great place for a do-while
-    while(tempEntry):
-      yield tempEntry
-      tempEntry = self._nextEntry()
+    return self._filestream.readTable(self._FIELDS)
 
   def insertEntries(self, newEntries):
     """Given an iterable object of NewTopics, insert them.
 
+    Unless .index is empty or the Index keeps no segments, the new entries
+    are written to a new delta segment, and compact() is started in the
+    background if the segments have grown past their limits. Otherwise they
+    are merged into .index.
+
+    """
+    newEntries = list(newEntries)
+    if not newEntries:
+      return
+    with self._lock:
+      if not self._segmented or not len(self):
+        self._rewrite(newEntries)
+        return
+      last = self._segments[-1]._filestream.name if self._segments else None
+      n = int(last[len(self._filestream.name) + 1:]) + 1 if last else 1
+      segment = Index(self._filestream.sibling(self._segmentName(n), "w+"),
+        False)
+      segment.insertEntries(newEntries)
+      self._segments.append(segment)
+      self._entries = None
+      if self._crowded() and self._compactor is None:
+        self._compactor = threading.Thread(target=self.compact)
+        self._compactor.start()
+
+  def _crowded(self):
+    """Return True if the segments have grown past their limits."""
+
+    return len(self._segments) > self._MAX_SEGMENTS or \
+      sum(len(s) for s in self._segments) > \
+      self._SEGMENT_RATIO * self._fileLength()
+
+  def compact(self):
+    """Merge the delta segments into .index and delete them.
+
+    The merged entries are written to a new file, which is then renamed over
+    .index, so .index is never left half written. Should this be
+    interrupted before the rename, .index is as it was and the next compact()
+    starts over; after it, the entries left in segments are exact copies of
+    entries in .index, which reads ignore.
+
+    The lock is only held to take the entries and to swap in the merged
+    file, so lookups and inserts go on while it is written. Segments
+    inserted meanwhile are kept for the next compact().
+
+    """
+    with self._compaction:
+      try:
+        with self._lock:
+          segments = list(self._segments)
+          if not segments:
+            return
+          entries = self.entries
+          name = self._filestream.name
+          merged = Index(self._filestream.sibling(name + self._COMPACTING,
+            "w+"), False)
+        merged._rewrite(entries)
+        with self._lock:
+          merged._filestream.rename(name)
+          self._addCounts(self._retired, self._filestream.stats())
+          self._addCounts(self._retired, merged._counts)
+          self._filestream.close()
+          self._filestream = merged._filestream
+          for segment in segments:
+            self._addCounts(self._retired, segment.stats())
+            segment.close()
+            os.remove(segment._filestream.name)
+          self._segments = self._segments[len(segments):]
+          self._entries = None
+          self._counts["compactions"] += 1
+      finally:
+        if self._compactor is threading.current_thread():
+          self._compactor = None
+
+  def _rewrite(self, newEntries):
+    """Given an iterable object of NewTopics, merge them into .index.
+
     Entries in .index are kept in sorted order, so self.entries and
     entries must be merged together and written to .index in sorted order.
+    All entries are buffered and reach the disk in a single write.
 
     """
     oldEntries = self.entries
+    self._setWrite()
+    self._filestream.bufferWrites()
     j = 0
     for i in newEntries:
       while j < len(oldEntries) and oldEntries[j].name < i.name:
@@ -120,6 +402,7 @@ class Index(object):
     while j < len(oldEntries):
       self._write(oldEntries[j])
       j+=1
+    self._filestream.commit()
 
   def _write(self, newTopic):
     """Given a newTopic object, write its name, offset, and endset to disk.
@@ -136,9 +419,348 @@ class Index(object):
       format(newTopic.offset, self._OFFSET_LENGTH))
     self._filestream.write("{0:0{1}x}". \
       format(newTopic.endset, self._END_BYTE_LENGTH))
+    self._counts["entriesWritten"] += 1
     #self.entries are no longer accurate: cause them to reload
     self._entries = None
 
+class BTreeIndex(object):
+  """Index stored as an on-disk B+-tree of fixed-size, encrypted pages.
+
+  BTreeIndex has the interface of Index and gives out the same FindTopics,
+  but inserts, lookups and range scans only read and write the O(log n)
+  pages on the path from the root to a leaf, so a vault with millions of
+  topics never rewrites its whole index.
+
+  Every page is PAGE_SIZE bytes, read and written whole with pread() and
+  pwrite(), so any file format works. Page 0 holds _MAGIC, the root page,
+  the number of pages and the number of entries. A leaf page holds 'L',
+  its number of entries, the page of the next leaf and its entries, each
+  written as in an .index file. An internal page holds 'I', its number of
+  keys, the pages of its children and its keys, which are entries too.
+  Entries are ordered by their padded names, so entries with equal human
+  readable names come in the random order of their padding.
+
+  Class Variables:
+    PAGE_SIZE the size(in bytes) of a page, the same as PageCache.PAGE_SIZE
+      so that pages line up with those of a PageCache.
+    _MAGIC string the first page starts with.
+    _PAGE_WIDTH the number of hexadecimal digits of a page number.
+    _COUNT_WIDTH the number of hexadecimal digits of a count of entries.
+    _LEAF_HEADER size(in bytes) of the type, count and next leaf of a leaf.
+    _INTERNAL_HEADER size(in bytes) of the type and count of an internal page.
+    LEAF_CAPACITY the most entries a leaf page holds.
+    INTERNAL_CAPACITY the most keys an internal page holds.
+
+  Member Variables:
+    _filestream the EncryptedFile the pages are stored in.
+    _root the page number of the root.
+    _pages the number of pages in the file.
+    _count the number of entries in the tree.
+    _dirty dictionary of the nodes changed by insertEntries() and not yet
+      written, by page number.
+    _entries EntryStore of all entries, or None until 'entries' is accessed.
+    _counts dictionary counting the pages read and written, the splits and
+      the entries loaded and written.
+    _lock RLock held by reads and writes.
+
+  """
+
+  PAGE_SIZE = xor.CHUNK
+  _MAGIC = "\x00BPT"
+  _PAGE_WIDTH = 8
+  _COUNT_WIDTH = 4
+  _LEAF_HEADER = 1 + _COUNT_WIDTH + _PAGE_WIDTH
+  _INTERNAL_HEADER = 1 + _COUNT_WIDTH
+  LEAF_CAPACITY = (PAGE_SIZE - _LEAF_HEADER) // Index._ENTRY_LENGTH
+  INTERNAL_CAPACITY = (PAGE_SIZE - _INTERNAL_HEADER - _PAGE_WIDTH) // \
+    (Index._ENTRY_LENGTH + _PAGE_WIDTH)
+
+  def __init__(self, filestream):
+    """Initialize a BTreeIndex given an EncryptedFile opened for reading and
+    writing. An empty file gets an empty tree."""
+
+    self._filestream = filestream
+    self._dirty = {}
+    self._entries = None
+    self._counts = {"pageReads": 0, "pageWrites": 0, "splits": 0,
+      "loads": 0, "entriesLoaded": 0, "entriesWritten": 0}
+    self._lock = threading.RLock()
+    if filestream.size() == 0:
+      self._root, self._pages, self._count = 1, 2, 0
+      self._dirty[1] = _Node(True)
+      self._flush()
+    else:
+      meta = self._readPage(0)
+      if not meta.startswith(self._MAGIC):
+        raise ValueError("{0} is not a B+-tree index".format(filestream.name))
+      i = len(self._MAGIC)
+      w = self._PAGE_WIDTH
+      self._root = int(meta[i:i+w], 16)
+      self._pages = int(meta[i+w:i+2*w], 16)
+      self._count = int(meta[i+2*w:i+3*w], 16)
+
+  @staticmethod
+  def _key(entry):
+    """Return the sort key of an entry: its padded name, then its offset,
+    largest first."""
+
+    return entry[0], -entry[1]
+
+  @staticmethod
+  def _encode(entries):
+    """Return entries written the way an .index file holds them.
+
+    NOTE: If Index.OFFSET_BASE changes from 16, this must change as well.
+
+    """
+    return "".join("{0}{1:0{3}x}{2:0{4}x}".format(name, offset, endset,
+      Index._OFFSET_LENGTH, Index._END_BYTE_LENGTH) \
+      for name, offset, endset in entries)
+
+  @staticmethod
+  def _decode(table):
+    """Return the list of (name, offset, endset) entries of table."""
+
+    store = EntryStore.fromTable(table)
+    return [(store.name(i), store.offsets[i], store.endsets[i]) \
+      for i in xrange(len(store))]
+
+  def _readPage(self, page):
+    """Return the decrypted bytes of the given page."""
+
+    self._counts["pageReads"] += 1
+    return self._filestream.pread(page * self.PAGE_SIZE, self.PAGE_SIZE)
+
+  def _node(self, page):
+    """Return the _Node stored in the given page."""
+
+    if page in self._dirty:
+      return self._dirty[page]
+    data = self._readPage(page)
+    n = int(data[1:1+self._COUNT_WIDTH], 16)
+    e = Index._ENTRY_LENGTH
+    if data[0] == "L":
+      node = _Node(True)
+      node.next = int(data[1+self._COUNT_WIDTH:self._LEAF_HEADER], 16)
+      node.entries = self._decode(data[self._LEAF_HEADER:
+        self._LEAF_HEADER+n*e])
+      return node
+    node = _Node(False)
+    i = self._INTERNAL_HEADER
+    w = self._PAGE_WIDTH
+    node.children = [int(data[j:j+w], 16) for j in xrange(i, i+(n+1)*w, w)]
+    i += (n + 1) * w
+    node.entries = self._decode(data[i:i+n*e])
+    return node
+
+  def _writeNode(self, page, node):
+    """Write the given _Node to its page, padded to PAGE_SIZE."""
+
+    if node.leaf:
+      data = "L{0:0{2}x}{1:0{3}x}".format(len(node.entries), node.next,
+        self._COUNT_WIDTH, self._PAGE_WIDTH)
+    else:
+      data = "I{0:0{1}x}".format(len(node.entries), self._COUNT_WIDTH) + \
+        "".join("{0:0{1}x}".format(c, self._PAGE_WIDTH) \
+        for c in node.children)
+    data += self._encode(node.entries)
+    self._counts["pageWrites"] += 1
+    self._filestream.pwrite(page * self.PAGE_SIZE,
+      data + FindTopic.NULL * (self.PAGE_SIZE - len(data)))
+
+  def _flush(self):
+    """Write every changed node, then the first page."""
+
+    for page in sorted(self._dirty):
+      self._writeNode(page, self._dirty[page])
+    self._dirty = {}
+    meta = self._MAGIC + "".join("{0:0{1}x}".format(v, self._PAGE_WIDTH) \
+      for v in (self._root, self._pages, self._count))
+    self._counts["pageWrites"] += 1
+    self._filestream.pwrite(0,
+      meta + FindTopic.NULL * (self.PAGE_SIZE - len(meta)))
+
+  def _allocate(self, node):
+    """Return the number of a new page holding the given _Node."""
+
+    page = self._pages
+    self._pages += 1
+    self._dirty[page] = node
+    return page
+
+  def close(self):
+    """Close and Flush the internal filestream of the BTreeIndex."""
+
+    self._filestream.close()
+
+  def stats(self):
+    """Return the counters of the BTreeIndex merged with those of its file."""
+
+    with self._lock:
+      return dict(self._filestream.stats(), pages=self._pages, **self._counts)
+
+  def files(self):
+    """Return the names of every file the BTreeIndex is stored in."""
+
+    return [self._filestream.name]
+
+  def __len__(self):
+    """Return the number of entries."""
+
+    return self._count
+
+  @property
+  def entries(self):
+    """Lazily load all entries into memory by walking the leaves in order.
+
+    Return a sorted EntryStore, a sequence of FindTopic objects.
+    """
+
+    with self._lock:
+      if self._entries is None:
+        page = self._root
+        node = self._node(page)
+        while not node.leaf:
+          node = self._node(node.children[0])
+        tables = [self._encode(node.entries)]
+        while node.next:
+          node = self._node(node.next)
+          tables.append(self._encode(node.entries))
+        self._entries = EntryStore.fromTable("".join(tables))
+        self._counts["loads"] += 1
+        self._counts["entriesLoaded"] += len(self._entries)
+      return self._entries
+
+  def iterate(self, start=""):
+    """Yield FindTopics in order, from the first whose name is >= start.
+
+    Only the pages on the path to the first leaf and the leaves after it
+    are read.
+
+    """
+    with self._lock:
+      #No entry sorts before its name with an offset of infinity.
+      key = (start, float("-inf"))
+      node = self._node(self._root)
+      while not node.leaf:
+        keys = [self._key(e) for e in node.entries]
+        node = self._node(node.children[bisect.bisect_right(keys, key)])
+      i = bisect.bisect_left([self._key(e) for e in node.entries], key)
+    while True:
+      for name, offset, endset in node.entries[i:]:
+        yield FindTopic.parsed(name, offset, endset)
+      if not node.next:
+        return
+      with self._lock:
+        node = self._node(node.next)
+      i = 0
+
+  def lookup(self, name):
+    """Return the FindTopic of the entry with the given human readable name.
+
+    Return None if there is none. If there are several, which one is
+    returned depends on their random padding.
+
+    """
+    #Names are padded after a NULL, the smallest character, so the padded
+    #names of an entry sort right after name itself.
+    topic = next(self.iterate(name + FindTopic.NULL), None)
+    if topic is not None and topic.cleanName() == name:
+      return topic
+
+  def prefixRange(self, prefix):
+    """Return a sorted list of the FindTopics whose names start with prefix."""
+
+    found = []
+    for topic in self.iterate(prefix):
+      if not topic.name.startswith(prefix):
+        break
+      found.append(topic)
+    return found
+
+  def insertEntries(self, newEntries):
+    """Given an iterable object of NewTopics, insert them.
+
+    Each entry is inserted into its leaf, splitting full pages on the way
+    back up. Changed pages are held until all entries are inserted and
+    then written once each.
+
+    """
+    with self._lock:
+      for topic in newEntries:
+        entry = (topic.name, topic.offset, topic.endset)
+        split = self._insert(self._root, entry)
+        if split is not None:
+          root = _Node(False)
+          root.entries = [split[0]]
+          root.children = [self._root, split[1]]
+          self._root = self._allocate(root)
+        self._count += 1
+        self._counts["entriesWritten"] += 1
+      self._flush()
+      self._entries = None
+
+  def _insert(self, page, entry):
+    """Insert entry below the given page.
+
+    Return None, or the first key and page number of the new right sibling
+    of the page if it had to be split.
+
+    """
+    node = self._node(page)
+    keys = [self._key(e) for e in node.entries]
+    i = bisect.bisect_right(keys, self._key(entry))
+    if node.leaf:
+      self._dirty[page] = node
+      node.entries.insert(i, entry)
+      if len(node.entries) <= self.LEAF_CAPACITY:
+        return None
+      half = len(node.entries) // 2
+      right = _Node(True)
+      right.entries = node.entries[half:]
+      node.entries = node.entries[:half]
+      right.next = node.next
+      node.next = self._allocate(right)
+      self._counts["splits"] += 1
+      return right.entries[0], node.next
+    split = self._insert(node.children[i], entry)
+    if split is None:
+      return None
+    self._dirty[page] = node
+    node.entries.insert(i, split[0])
+    node.children.insert(i + 1, split[1])
+    if len(node.entries) <= self.INTERNAL_CAPACITY:
+      return None
+    half = len(node.entries) // 2
+    right = _Node(False)
+    up = node.entries[half]
+    right.entries = node.entries[half+1:]
+    right.children = node.children[half+1:]
+    node.entries = node.entries[:half]
+    node.children = node.children[:half+1]
+    self._counts["splits"] += 1
+    return up, self._allocate(right)
+
+class _Node(object):
+  """Decoded page of a BTreeIndex.
+
+  Member Variables:
+    leaf True for a leaf, False for an internal page.
+    entries list of the (name, offset, endset) entries of a leaf, or of the
+      keys of an internal page, in order.
+    children list of the page numbers of the children of an internal page.
+    next the page number of the next leaf, or 0 for the last leaf.
+
+  """
+
+  def __init__(self, leaf):
+    """Initialize an empty leaf or internal _Node."""
+
+    self.leaf = leaf
+    self.entries = []
+    self.children = []
+    self.next = 0
+
 class Corpora(object):
   """Corpora controller for specialized reads and writes to a .corpora file.
 
@@ -151,6 +773,7 @@ class Corpora(object):
 
   Member Variables:
     _filestream the actual .corpora file-like object to read and write from.
+    _counts dictionary counting the corpora read and written.
 
   """
 
@@ -158,19 +781,21 @@ class Corpora(object):
     """Initialize a Corpora object given an *opened* .corpora file."""
 
     self._filestream = filestream
+    self._counts = {"corporaRead": 0, "corporaWritten": 0}
 
   def _setAppend(self):
-    """Reopen the internal file object for append mode.
+    """Switch the internal file object to append mode.
     
-    If _filestream is already opened in 'a' mode, nothing happens.
+    If _filestream is already in 'a' mode, nothing happens. A filestream
+    opened for reading and writing is positioned at its end, not reopened.
     
     """
     self._filestream = self._filestream.reOpen("a")
 
   def _setRead(self):
-    """Reopen the internal file object for read mode and flush the I/O buffer.
+    """Switch the internal file object to read mode and flush the I/O buffer.
     
-    If _filestream is already opened in 'r' mode, nothing happens.
+    If _filestream is already in 'r' mode, nothing happens.
 
     """
     self._filestream = self._filestream.reOpen("r")
@@ -180,12 +805,29 @@ class Corpora(object):
 
     self._filestream.close()
 
-  def getCorpus(self, topic):
-    """Given a FindTopic object, locate and return its corresponding corpus."""
+  def stats(self):
+    """Return the counters of the Corpora merged with those of its file."""
 
+    return dict(self._filestream.stats(), **self._counts)
+
+  def getCorpus(self, topic, start=0, end=None):
+    """Given a FindTopic object, locate and return its corresponding corpus.
+
+    Optionally return only the bytes [start:end) of the corpus. If the
+    .corpora file supports partial reads, only that range is read and
+    decrypted; otherwise the whole corpus is decrypted and then sliced.
+    The corpus is read with pread(), so once the Corpora is in read mode
+    any number of threads may get corpora at once.
+
+    """
+    length = topic.endset - topic.offset
+    end = length if end is None else min(end, length)
+    start = min(start, end)
     self._setRead()
-    (self._filestream).seek(topic.offset)
-    return self._filestream.read(topic.endset - topic.offset)
+    self._counts["corporaRead"] += 1
+    if not self._filestream.partialReads:
+      return self._filestream.pread(topic.offset, length)[start:end]
+    return self._filestream.pread(topic.offset + start, end - start)
 
   def _write(self, newTopic):
     """Given a NewTopic object, write its corpus to disk.
@@ -197,12 +839,19 @@ class Corpora(object):
     self._setAppend()
     newTopic.setOffset(self._filestream.tell())
     self._filestream.write(newTopic.corpus)
+    self._counts["corporaWritten"] += 1
 
   def insertEntries(self, newEntries):
-    """Given an iterable object over NewTopic objects, write them to disk."""
+    """Given an iterable object over NewTopic objects, write them to disk.
+
+    All corpora are buffered and reach the disk in a single write.
 
+    """
+    self._setAppend()
+    self._filestream.bufferWrites()
     for n in newEntries:
       self._write(n)
+    self._filestream.commit()
 
 class FindTopic(object):
   """Find Topic object with name and offset.
@@ -240,11 +889,154 @@ class FindTopic(object):
     self.offset = int(raw_offset, Index.OFFSET_BASE)
     self.endset = int(raw_endset, Index.OFFSET_BASE)
 
+  @staticmethod
+  def parsed(name, offset, endset):
+    """Create a FindTopic from a raw name and an already parsed offset and
+    endset."""
+
+    topic = FindTopic.__new__(FindTopic)
+    topic.name = name
+    topic.offset = offset
+    topic.endset = endset
+    return topic
+
   def cleanName(self):
     """Return the name field human readable."""
 
     return self.name[:self.name.rfind(self.NULL)]
 
+class EntryStore(object):
+  """Compact, sorted sequence of the entries of an .index file.
+
+  The entries are held as a struct of arrays rather than as one FindTopic
+  each: the raw names of all entries in a single string, Index._NAME_LENGTH
+  bytes apart, and the offsets and endsets in two arrays. A FindTopic is
+  only made when an entry is accessed.
+
+  Class Variables:
+    TYPECODE the array typecode of offsets and endsets. Python 2 arrays have
+      no 'Q', but 'L' holds any offset of Index._OFFSET_LENGTH digits.
+
+  Member Variables:
+    _names the raw names of all entries, concatenated.
+    offsets array of the offset of every entry.
+    endsets array of the endset of every entry.
+
+  """
+
+  TYPECODE = "L"
+
+  def __init__(self, names="", offsets=(), endsets=()):
+    """Initialize an EntryStore given the raw names of the entries, all
+    concatenated, and iterables over their offsets and endsets."""
+
+    self._names = names
+    self.offsets = array(self.TYPECODE, offsets)
+    self.endsets = array(self.TYPECODE, endsets)
+
+  @staticmethod
+  def fromTable(table):
+    """Create an EntryStore from the decrypted bytes of whole entries.
+
+    Every field is gathered from all entries at once with strided slices,
+    and the offsets and endsets are parsed by a single unhexlify() rather
+    than one int() each.
+
+    """
+    e = Index._ENTRY_LENGTH
+    n = len(table) // e
+    names = bytearray(n * Index._NAME_LENGTH)
+    for j in xrange(Index._NAME_LENGTH):
+      names[j::Index._NAME_LENGTH] = table[j:n*e:e]
+    store = EntryStore(str(names))
+    store.offsets = EntryStore._parse(table, n, Index._NAME_LENGTH,
+      Index._OFFSET_LENGTH)
+    store.endsets = EntryStore._parse(table, n,
+      Index._NAME_LENGTH + Index._OFFSET_LENGTH, Index._END_BYTE_LENGTH)
+    return store
+
+  @staticmethod
+  def _parse(table, n, start, width):
+    """Return an array of the hexadecimal fields of width digits found at
+    start of each of the n entries in table.
+
+    NOTE: If Index.OFFSET_BASE changes from 16, this must change as well.
+
+    """
+    e = Index._ENTRY_LENGTH
+    a = array(EntryStore.TYPECODE)
+    #Left pad every field with zeros to the digits of one array item, then
+    #read the items back as big-endian integers.
+    digits = 2 * a.itemsize
+    hexes = bytearray("0" * (n * digits))
+    for j in xrange(width):
+      hexes[digits-width+j::digits] = table[start+j:n*e:e]
+    a.fromstring(unhexlify(str(hexes)))
+    if sys.byteorder == "little":
+      a.byteswap()
+    return a
+
+  @staticmethod
+  def merge(stores):
+    """Merge sorted EntryStores into one sorted EntryStore.
+
+    Entries with equal padded names keep the order of the stores they come
+    from. An entry found in several stores with the same name, offset and
+    endset is only kept once.
+
+    """
+    merged = EntryStore()
+    names = []
+    last, seen = None, set()
+    for name, r, i in heapq.merge(*[EntryStore._keyed(s, r) \
+        for r, s in enumerate(stores)]):
+      entry = (name, stores[r].offsets[i], stores[r].endsets[i])
+      if name != last:
+        last, seen = name, set()
+      if entry not in seen:
+        seen.add(entry)
+        names.append(name)
+        merged.offsets.append(entry[1])
+        merged.endsets.append(entry[2])
+    merged._names = "".join(names)
+    return merged
+
+  @staticmethod
+  def _keyed(store, rank):
+    """Yield (name, rank, i) for the i-th entry of store, in order."""
+
+    for i in xrange(len(store)):
+      yield store.name(i), rank, i
+
+  def __len__(self):
+    """Return the number of entries."""
+
+    return len(self.offsets)
+
+  def name(self, i):
+    """Return the raw name of the i-th entry without making a FindTopic."""
+
+    if i < 0:
+      i += len(self)
+    return self._names[i*Index._NAME_LENGTH:(i+1)*Index._NAME_LENGTH]
+
+  def __getitem__(self, i):
+    """Return a FindTopic for the i-th entry, or a list for a slice."""
+
+    if isinstance(i, slice):
+      return [self[j] for j in xrange(*i.indices(len(self)))]
+    if i < 0:
+      i += len(self)
+    if not 0 <= i < len(self):
+      raise IndexError("entry index out of range")
+    return FindTopic.parsed(self.name(i), self.offsets[i], self.endsets[i])
+
+  def __iter__(self):
+    """Yield a FindTopic for every entry, in order."""
+
+    for i in xrange(len(self)):
+      yield self[i]
+
 class NewTopic(object):
   """New Topic object with name and corpus.
 
@@ -343,7 +1135,100 @@ class NewTopic(object):
 
     return self > obj or self == obj
 
-class EncryptedFile(file):
+class PageCache(object):
+  """Least recently used cache of decrypted pages of EncryptedFiles.
+
+  Files are cut into pages of PAGE_SIZE bytes of data, counted from the
+  first byte after the header, and each page is held decrypted under the
+  name of its file and its page number. Pages are evicted, least recently
+  used first, once they hold more than budget bytes. Only full pages are
+  held, since the last page of a file may still grow. One cache may be
+  shared by any number of files and threads. Pages are loaded without the
+  lock held, so a page whose file had pages dropped while it was loading is
+  returned but not held: it may have been read before the change.
+
+  Class Variables:
+    PAGE_SIZE the size(in bytes) of a page. It is a multiple of xor.CHUNK,
+      so every page of a CHUNKED file is deciphered on its own.
+    BUDGET the default number of bytes to hold.
+
+  Member Variables:
+    budget the most bytes of pages held before the oldest are evicted.
+    hits the number of pages get() found in the cache.
+    misses the number of pages get() had to load.
+    _pages OrderedDict mapping (name, page number) to a page, oldest first.
+    _size the total size(in bytes) of the pages held.
+    _generations dictionary mapping a name to the number of drop() calls
+      made for it.
+    _lock Lock held while _pages or _generations is changed.
+
+  """
+
+  PAGE_SIZE = xor.CHUNK
+  BUDGET = 1 << 22
+
+  def __init__(self, budget=BUDGET):
+    """Initialize an empty cache holding at most budget bytes of pages."""
+
+    self.budget = budget
+    self.hits = self.misses = self._size = 0
+    self._pages = OrderedDict()
+    self._generations = {}
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    """Return the number of pages currently held."""
+
+    return len(self._pages)
+
+  def get(self, name, page, load):
+    """Return the given page of the file name, calling load() on a miss."""
+
+    with self._lock:
+      data = self._pages.pop((name, page), None)
+      if data is not None:
+        self.hits += 1
+        self._pages[(name, page)] = data
+        return data
+      self.misses += 1
+      generation = self._generations.get(name, 0)
+    data = load()
+    if len(data) < self.PAGE_SIZE:
+      return data
+    with self._lock:
+      if self._generations.get(name, 0) != generation:
+        return data
+      if (name, page) in self._pages:
+        self._size -= len(self._pages.pop((name, page)))
+      self._pages[(name, page)] = data
+      self._size += len(data)
+      while self._size > self.budget:
+        self._size -= len(self._pages.popitem(last=False)[1])
+    return data
+
+  def drop(self, name, start=0, end=None):
+    """Drop the pages [start:end) of the file name, all from start on if
+    end is None."""
+
+    with self._lock:
+      self._generations[name] = self._generations.get(name, 0) + 1
+      if end is not None and end - start <= len(self._pages):
+        keys = [(name, p) for p in xrange(start, end)]
+      else:
+        keys = [k for k in self._pages if k[0] == name and k[1] >= start \
+          and (end is None or k[1] < end)]
+      for k in keys:
+        data = self._pages.pop(k, None)
+        if data is not None:
+          self._size -= len(data)
+
+  def stats(self):
+    """Return a dictionary of the hits, misses, pages and bytes held."""
+
+    return {"hits": self.hits, "misses": self.misses,
+      "pages": len(self._pages), "bytes": self._size}
+
+class EncryptedFile(io.RawIOBase):
   """Encrypted file stream with the same interface as a normal file.
 
   Encrypted file has the same interface as a normal file, but uses an 
@@ -351,61 +1236,625 @@ class EncryptedFile(file):
   For this purpose, an additional encryption key is needed for file 
   operations. This key will not be saved as plaintext in memory.
 
+  EncryptedFile is a raw, unbuffered io stream over an io.FileIO: reads go
+  through readinto(), which fills and decrypts the caller's buffer, so
+  io.BufferedReader (see reader()) and anything else built on the io module
+  can wrap it. pread() and pwrite() read and write at a given offset without
+  touching the file position, so several threads may pread() at once.
+  Files that allow partial reads may be given a PageCache, and are then read
+  a page at a time, every page being decrypted only once while it is held.
+  If such a file is mapped as well, the cache serves the reads and the pages
+  it misses are sliced out of the mmap.
+
+  The format of a file is one of the cipher backends in xor.BACKENDS and
+  its version is the ID of that backend. LEGACY files have no header and
+  every write() is enciphered as a whole with xor.cipher(), so data can only
+  be read back with reads of exactly the same size. Every other file starts
+  with a header of _MAGIC followed by the version byte. CHUNKED files are
+  enciphered with xor.scipher(), so any byte range can be read on its own.
+  seek() and tell() hide the header: offsets always count from the first
+  byte of data.
+
   Class Variables:
-    _ENCRYPT the encryption function with which I/O goes through this file.
-      This function must have the interface: func(data,key) and serve as both
-      an encryption and decryption function.
+    LEGACY version number of the header-less, write length dependant format.
+    CHUNKED version number of the seekable, chunked format.
+    VERSION version number new files are created with.
+    _MAGIC string every versioned file starts with.
+    _HEADER_LENGTH size(in bytes) of the header of a versioned file.
+    BUFFER_SIZE size(in bytes) of the blocks reader() reads ahead in.
 
   Member Variables:
-    _access generated encryption key to encrypt the passed-in file encryption 
-      key with.
-    _key the key with which to decrypt the file. This is user provided.
+    name the name or path of the file.
+    mode the mode the file was opened with.
+    _file the io.FileIO the encrypted bytes are read from and written to.
+    _key xor.Key with which to decrypt the file. It is prepared once from
+      the user provided key, keeps the key obfuscated in memory and caches
+      the keystreams used for reads and writes, so fixed-width fields only
+      derive a keystream once. reOpen() hands it on to the new instance.
+    version the format version of the file.
+    _backend the xor.Backend that enciphers and deciphers the file.
+    _headerLength size(in bytes) of the header actually in front of the data.
+    _mode the mode, 'r', 'w' or 'a', that the file was last reOpen()ed in.
+      Files opened for both reading and writing ('+' modes) are never closed
+      and reopened; reOpen() only repositions them.
+    reopens the number of times reOpen() had to close this file and open a
+      new instance to get here.
+    _counts dictionary of the counters stats() reports, carried over to the
+      instance reOpen() returns.
+    _pending list of encrypted strings written since bufferWrites() and not
+      yet committed, or None when writes are not being buffered.
+    _pendingLength the total size(in bytes) of the strings in _pending.
+    mapped True if reads should be served from a read-only mmap of the file
+      rather than through _file.
+    _map the mmap reads are currently served from, or None. It is dropped by
+      anything that writes and made again by the next read.
+    _pmap the mmap the pages the cache misses are sliced from, or None. It
+      is never seeked, so pread()s in other threads don't move the file
+      position. It is dropped with _map and made again by the next miss.
+    _positional lock held by pread() and pwrite() where the os module has no
+      pread()/pwrite() and they have to seek a file object of their own, and
+      while _pmap is made, sliced or dropped.
+    _preader the io.FileIO pread() seeks and reads from in that case, opened
+      by the first pread(), or None.
+    _cache the PageCache reads are served from, or None. It is only used if
+      the file allows partial reads and is handed on by reOpen().
 
   """
 
-  @staticmethod
-  def _ENCRYPT(*args):
-    """Wrapper to have a static method make a function."""
-    return xor.cipher(*args)
-    return args[0]
-  _DECRYPT = _ENCRYPT 
+  LEGACY = xor.XorBackend.ID
+  CHUNKED = xor.ChunkedBackend.ID
+  VERSION = CHUNKED
+  _MAGIC = "DMP"
+  _HEADER_LENGTH = len(_MAGIC) + 1
+  BUFFER_SIZE = 16 * xor.CHUNK
+  _COUNTERS = ("reads", "bytesRead", "writes", "bytesWritten", "seeks",
+    "cipherSeconds")
 
-  def __init__(self,name,key,mode="r"):
+  def __init__(self,name,key,mode="r",version=None,mapped=False,cache=None):
     """Encrypted file initializer.
 
     Params:
       name a string containing the name or path of the file to open.
       mode the mode with which to open the file.
-      key the encryption key to use for encryption and decryption.
+      key the encryption key to use for encryption and decryption. This may
+        be a string or a prepared xor.Key.
+      version the format version to create a new or truncated file with,
+        one of the keys of xor.BACKENDS. Defaults to EncryptedFile.VERSION.
+        Existing files keep their format.
+      mapped whether to serve reads from an mmap of the file.
+      cache a PageCache to serve reads from, or None.
     Note: None of the parameters may be omitted as that would interfere with
     the built-in keyword arguments and/or confuse the interface.
 
     """
-    file.__init__(self,name,mode)
-    #Generate a random key to encrypt the file key with.
-    self._access = reduce(lambda x,y:x+y,map(lambda _:chr(randint(0,255)),range(255)))
-    self.__key = self._ENCRYPT(key,self._access)
+    io.RawIOBase.__init__(self)
+    self._file = self._key = self._map = self._pmap = self._pending = None
+    self._preader = None
+    self._pendingLength = 0
+    self._positional = threading.Lock()
+    self._counts = dict.fromkeys(self._COUNTERS, 0)
+    self._file = io.FileIO(name, mode.replace("b", ""))
+    self.name = name
+    self.mode = mode
+    self._key = key if isinstance(key, xor.Key) else xor.Key(key)
     key = None
+    self._mode = mode[0]
+    self.reopens = 0
+    self.mapped = mapped
+    self._cache = cache
+    if cache is not None and "w" in mode:
+      cache.drop(name)
+    self._openHeader(self.VERSION if version is None else version)
+
+  def _openHeader(self, version):
+    """Determine the format version of the file, writing a header if needed.
+
+    Truncated and empty files get a header for the given version; any other
+    file is read as whatever format its header names, or as LEGACY if it
+    has none.
+
+    LEGACY files have no header at all, so one whose first ciphertext bytes
+    happen to be _MAGIC followed by the ID of a backend is misread as that
+    format. For a uniformly random ciphertext the odds are 3 in 2**32 per
+    file; the magic is kept this short because existing files carry it.
+
+    """
+    head = ""
+    if "w" not in self.mode:
+      with open(self.name, "rb") as f:
+        head = f.read(self._HEADER_LENGTH)
+    if not head and self.writable():
+      self.version = version
+      if version != self.LEGACY:
+        self._writeAll(self._MAGIC + chr(version))
+    elif len(head) == self._HEADER_LENGTH and head.startswith(self._MAGIC) \
+        and ord(head[-1]) in xor.BACKENDS and ord(head[-1]) != self.LEGACY:
+      self.version = ord(head[-1])
+    else:
+      self.version = self.LEGACY
+    self._backend = xor.BACKENDS[self.version]
+    self._headerLength = self._HEADER_LENGTH if self.version else 0
+    if "a" not in self.mode and self._file.tell() < self._headerLength:
+      self._file.seek(self._headerLength)
 
   @property
-  def _key(self):
-    """Return the plaintext key for the Encrypted file."""
+  def partialReads(self):
+    """Return True if any byte range of the file can be decrypted alone."""
+
+    return self._backend.SEEKABLE
+
+  def readable(self):
+    """Return True if the file was opened for reading."""
+
+    return self._file.readable()
+
+  def writable(self):
+    """Return True if the file was opened for writing."""
+
+    return self._file.writable()
+
+  def seekable(self):
+    """Return True: offsets can always be seeked to."""
+
+    return True
+
+  def fileno(self):
+    """Return the file descriptor of the underlying file."""
+
+    return self._file.fileno()
+
+  def sibling(self, name, mode):
+    """Open another EncryptedFile with the same key, format and options."""
+
+    return self.__class__(name, self._key.plaintext(), mode, self.version,
+      self.mapped, self._cache)
+
+  def rename(self, name):
+    """Commit any buffered writes and rename the file to name, replacing any
+    file of that name at once.
+
+    The file stays open under its new name. The cached pages of both names
+    are dropped.
+
+    """
+    self.commit()
+    os.rename(self.name, name)
+    self._invalidate(0)
+    self.name = name
+    self._invalidate(0)
+
+  def reader(self):
+    """Return an io.BufferedReader over this file reading BUFFER_SIZE blocks.
+
+    Only files that allow partial reads can be read in arbitrary blocks;
+    for any other file ValueError is raised. Closing the reader closes
+    this file.
+
+    """
+    if not self.partialReads:
+      raise ValueError("{0} files can only be read in the sizes written". \
+        format(self._backend.NAME))
+    return io.BufferedReader(self, self.BUFFER_SIZE)
+
+  def stats(self):
+    """Return a dictionary of the I/O this file has done so far.
+
+    reads and writes count the reads and writes of the underlying file,
+    bytesRead and bytesWritten the encrypted bytes they moved, seeks the
+    seeks of the underlying file and cipherSeconds the time spent
+    enciphering and deciphering. reopens is the number of reOpen()s that
+    had to open a new instance. Counts include every instance reOpen() left
+    behind.
+
+    """
+    stats = dict(self._counts)
+    stats["reopens"] = self.reopens
+    return stats
+
+  def _countRead(self, n):
+    """Count one read of the underlying file that returned n bytes."""
+
+    self._counts["reads"] += 1
+    self._counts["bytesRead"] += n
+
+  def _cipher(self, byte, pos):
+    """Encrypt or decrypt the given string found at the given offset."""
+
+    start = time.time()
+    byte = self._backend.cipher(byte, self._key, pos)
+    self._counts["cipherSeconds"] += time.time() - start
+    return byte
+
+  def _writeAll(self, byte):
+    """Write the whole string to the underlying file, as is."""
+
+    view = memoryview(byte)
+    while len(view):
+      n = self._file.write(view)
+      self._counts["writes"] += 1
+      self._counts["bytesWritten"] += n
+      view = view[n:]
+
+  def bufferWrites(self):
+    """Hold encrypted writes in memory until commit() is called.
+
+    The bytes written, and where they land, are exactly the same as without
+    buffering; tell() counts the buffered bytes. Any seek, read, truncate,
+    flush or reOpen commits the buffer first.
+
+    """
+    if self._pending is None:
+      self._pending = []
+      self._pendingLength = 0
+
+  def commit(self):
+    """Write all buffered writes with a single write() and stop buffering."""
+
+    if self._pending is not None:
+      pending = "".join(self._pending)
+      self._pending = None
+      self._pendingLength = 0
+      pos = self.tell()
+      self._writeAll(pending)
+      self._invalidate(pos, len(pending))
+
+  def flush(self):
+    """Commit any buffered writes."""
+
+    self.commit()
+    io.RawIOBase.flush(self)
+
+  def _mapping(self):
+    """Return the mmap to read from, mapping the file if needed.
+
+    Return None if reads are not mapped, writes are being buffered, the
+    file is empty or the file object is positioned past its end.
+
+    """
+    if self._map is None and self.mapped and self._pending is None:
+      size = os.fstat(self.fileno()).st_size
+      pos = self._file.tell()
+      if 0 < size and pos <= size:
+        self._map = mmap.mmap(self.fileno(), 0, access=mmap.ACCESS_READ)
+        self._map.seek(pos)
+    return self._map
+
+  def _unmap(self):
+    """Drop the mmaps, moving the file object to the offset _map reached."""
+
+    with self._positional:
+      self._dropPreadMap()
+    if self._map is not None:
+      pos = self._map.tell()
+      self._map.close()
+      self._map = None
+      self._file.seek(pos)
+
+  def _rawRead(self, size):
+    """Read size bytes, or all remaining bytes if size is negative, as is."""
+
+    m = self._mapping()
+    if m is None:
+      raw = self._file.read(size) or ""
+    else:
+      if size < 0:
+        size = len(m) - m.tell()
+      raw = m.read(size)
+    self._countRead(len(raw))
+    return raw
+
+  def _rawPread(self, offset, size):
+    """Read size bytes at the given offset of the underlying file, as is.
+
+    The file position is left where it was.
+
+    """
+    if hasattr(os, "pread"):
+      chunks = []
+      while size > 0:
+        chunk = os.pread(self.fileno(), size, offset)
+        self._countRead(len(chunk))
+        if not chunk:
+          break
+        chunks.append(chunk)
+        offset += len(chunk)
+        size -= len(chunk)
+      return "".join(chunks)
+    with self._positional:
+      if self._preader is None:
+        self._preader = io.FileIO(self.name, "r")
+      self._preader.seek(offset)
+      raw = self._preader.read(size) or ""
+      self._countRead(len(raw))
+      return raw
+
+  def _rawPwrite(self, offset, byte):
+    """Write the whole string at the given offset of the underlying file.
+
+    The file position is left where it was.
+
+    """
+    if hasattr(os, "pwrite"):
+      view = memoryview(byte)
+      while len(view):
+        n = os.pwrite(self.fileno(), view.tobytes(), offset)
+        self._counts["writes"] += 1
+        self._counts["bytesWritten"] += n
+        view = view[n:]
+        offset += n
+      return
+    with self._positional:
+      pos = self._file.tell()
+      self._file.seek(offset)
+      try:
+        self._writeAll(byte)
+      finally:
+        self._file.seek(pos)
+
+  def pread(self, offset, size):
+    """Read and decrypt size bytes at the given offset of the data.
+
+    Unlike seek() and read(), the file position is neither used nor moved,
+    so any number of threads may pread() the same file at once. Writes that
+    are still buffered are not seen. Unless the file allows partial reads,
+    offset and size must be those of a single earlier write().
+
+    """
+    if self._cached():
+      return self._cachedRead(offset, size)
+    return self._cipher(self._rawPread(offset + self._headerLength, size),
+      offset)
+
+  def pwrite(self, offset, byte):
+    """Encrypt and write a string at the given offset of the data.
+
+    The file position is neither used nor moved. Return the number of bytes
+    written, which is always all of them. As with os.pwrite(), files opened
+    in append mode may add the data to the end instead.
+
+    """
+    if not isinstance(byte, str):
+      byte = memoryview(byte).tobytes()
+    self.commit()
+    self._unmap()
+    self._rawPwrite(offset + self._headerLength, self._cipher(byte, offset))
+    self._invalidate(offset, len(byte))
+    return len(byte)
+
+  def size(self):
+    """Return the size(in bytes) of the data on disk, header excluded."""
+
+    return os.fstat(self.fileno()).st_size - self._headerLength
+
+  def _cached(self):
+    """Return True if reads are served from the page cache."""
+
+    return self._cache is not None and self.partialReads
 
-    return self._DECRYPT(self.__key, self._access)
+  def _page(self, page):
+    """Return the given page of decrypted data, from the cache if held."""
+
+    offset = page * self._cache.PAGE_SIZE
+    return self._cache.get(self.name, page, lambda: self._cipher(
+      self._mappedPread(offset + self._headerLength, self._cache.PAGE_SIZE),
+      offset))
+
+  def _mappedPread(self, offset, size):
+    """_rawPread() from _pmap if reads are mapped.
+
+    A slice cut short by the end of _pmap is read again with _rawPread(),
+    since the file may have grown since it was mapped.
+
+    """
+    raw = None
+    with self._positional:
+      if self._pmap is None and self.mapped and \
+          os.fstat(self.fileno()).st_size > 0:
+        self._pmap = mmap.mmap(self.fileno(), 0, access=mmap.ACCESS_READ)
+      if self._pmap is not None:
+        raw = self._pmap[offset:offset+size]
+    if raw is None or len(raw) < size:
+      return self._rawPread(offset, size)
+    self._countRead(len(raw))
+    return raw
+
+  def _dropPreadMap(self):
+    """Close _pmap. The caller must hold _positional."""
+
+    if self._pmap is not None:
+      self._pmap.close()
+      self._pmap = None
+
+  def _cachedRead(self, offset, size):
+    """Return size bytes of decrypted data from the given offset, or all
+    bytes to the end of the file if size is negative, read by pages."""
+
+    if size < 0:
+      size = self.size() - offset
+    if size <= 0:
+      return ""
+    n = self._cache.PAGE_SIZE
+    pages = []
+    for page in xrange(offset // n, (offset + size - 1) // n + 1):
+      pages.append(self._page(page))
+      #Only the last page of the file can be short.
+      if len(pages[-1]) < n:
+        break
+    start = offset % n
+    return "".join(pages)[start:start+size]
+
+  def _invalidate(self, offset, size=None):
+    """Drop the cached pages of the data from offset on, size bytes long or
+    to the end of the file if size is None.
+
+    Call it once the change is on disk: pages loaded before then are not
+    held.
+
+    """
+
+    if self._cache is not None:
+      n = self._cache.PAGE_SIZE
+      self._cache.drop(self.name, offset // n,
+        None if size is None else (offset + size - 1) // n + 1)
+
+  def seek(self, offset, whence=0):
+    """Seek to the given offset, counted from the first byte of data.
+
+    Return the new offset.
+
+    """
+    self.commit()
+    if whence == 0:
+      offset += self._headerLength
+    if self._map is not None:
+      pos = (0, self._map.tell(), len(self._map))[whence] + offset
+      if 0 <= pos <= len(self._map):
+        self._map.seek(pos)
+        return self.tell()
+      self._unmap()
+    self._file.seek(offset, whence)
+    self._counts["seeks"] += 1
+    return self.tell()
+
+  def tell(self):
+    """Return the current offset, counted from the first byte of data."""
+
+    if self._map is not None:
+      return self._map.tell() - self._headerLength
+    return self._file.tell() - self._headerLength + self._pendingLength
+
+  def truncate(self, size=None):
+    """Truncate the data to the given size, or to the current offset.
+
+    Return the new size.
+
+    """
+    self.commit()
+    if size is None:
+      size = self.tell()
+    start = min(size, self.size())
+    self._unmap()
+    #Slicing a mapping past the end of the file faults: don't let a pread()
+    #map the file again until it is cut.
+    with self._positional:
+      self._dropPreadMap()
+      self._file.truncate(size + self._headerLength)
+    self._invalidate(start)
+    return size
 
   def write(self, byte):
     """Write a string to an encrypted file.
 
     No encryption key is needed as an argument; it is saved upon instantiation.
-    The procedure encrypt(key,access) gives the plaintext key.
+    The procedure encrypt(key,access) gives the plaintext key. Return the
+    number of bytes written, which is always all of them.
 
     """
-    file.write(self, self._ENCRYPT(byte, self._key))
+    if not isinstance(byte, str):
+      byte = memoryview(byte).tobytes()
+    pos = self.tell()
+    enc = self._cipher(byte, pos)
+    self._unmap()
+    if self._pending is None:
+      self._writeAll(enc)
+      self._invalidate(pos, len(byte))
+    else:
+      self._pending.append(enc)
+      self._pendingLength += len(enc)
+    return len(byte)
 
   def read(self,size=-1):
     """Read bytes from the encrypted file given optional size."""
 
-    return self._DECRYPT(file.read(self,size), self._key)
+    self.commit()
+    pos = self.tell()
+    if self._cached():
+      byte = self._cachedRead(pos, size)
+      self.seek(pos + len(byte))
+      return byte
+    return self._cipher(self._rawRead(size), pos)
+
+  def readall(self):
+    """Read and decrypt everything up to the end of the file at once."""
+
+    return self.read()
+
+  def readinto(self, buf):
+    """Read into a bytearray or writable memoryview and decrypt it there.
+
+    Return the number of bytes read. Unless the file allows partial reads,
+    the bytes read are decrypted as a whole, like a read() of the same size.
+    The buffer saves the caller a result string, not work: mapped and cached
+    reads copy the bytes in, and decryption builds its result as read() does
+    before copying it back (see xor.sxor_into()).
+
+    """
+    self.commit()
+    pos = self.tell()
+    if self._cached():
+      view = memoryview(buf)
+      byte = self._cachedRead(pos, len(view))
+      view[:len(byte)] = byte
+      self.seek(pos + len(byte))
+      return len(byte)
+    if self._mapping() is None:
+      n = self._file.readinto(buf) or 0
+      view = memoryview(buf)[:n]
+    else:
+      view = memoryview(buf)
+      n = len(view)
+      raw = self._map.read(n)
+      n = len(raw)
+      view = view[:n]
+      view[:] = raw
+    self._countRead(n)
+    start = time.time()
+    self._backend.cipher_into(view, self._key, pos)
+    self._counts["cipherSeconds"] += time.time() - start
+    return n
+
+  def readTable(self, widths, count=-1):
+    """Read up to count records, or all records left, as one string.
+
+    widths is the size(in bytes) of every field of a record, in order, as
+    it was passed to its own write() call. Return the decrypted bytes of
+    every complete record read. They are read with a single read of the
+    underlying file, or a single slice of its mmap, and decrypted in one
+    pass, whatever the format. The page cache is bypassed, so a whole table
+    never pushes out the pages of other files.
+
+    """
+    self.commit()
+    pos = self.tell()
+    size = sum(widths)
+    raw = self._complete(self._rawRead(size * count if count >= 0 else -1),
+      size)
+    start = time.time()
+    raw = self._backend.cipher_records(raw, self._key, pos, widths)
+    self._counts["cipherSeconds"] += time.time() - start
+    return raw
+
+  @staticmethod
+  def _complete(raw, size):
+    """Return raw without the bytes of its last record if that is short."""
+
+    return raw[:len(raw) - len(raw) % size]
+
+  def readRecords(self, widths, count):
+    """Read up to count records of fields that were each written alone.
+
+    Return a flat list of the decrypted fields of every complete record
+    read by readTable().
+
+    """
+    table = self.readTable(widths, count)
+    fields = []
+    i = 0
+    while i < len(table):
+      for w in widths:
+        fields.append(table[i:i+w])
+        i += w
+    return fields
 
   def close(self):
     """Close this file object. 
@@ -414,23 +1863,115 @@ class EncryptedFile(file):
     collected. This is for both memory safety and security purposes.
 
     """
-    self.flush()
-    file.close(self)
-    self.__key = self._access = None
+    if self.closed:
+      return
+    if self._file is not None:
+      io.RawIOBase.close(self)
+      self._unmap()
+      self._file.close()
+    if self._preader is not None:
+      self._preader.close()
+      self._preader = None
+    if self._key:
+      self._key.clear()
+    self._key = None
 
   def reOpen(self, mode):
     """Return Encrypted file instance for the filestream opened in given mode.
 
     If the Encrypted file is already in the given mode, return itself. No key
-    is needed.
+    is needed. The new instance keeps the format version of this one.
+
+    A file opened for both reading and writing returns itself in any mode,
+    positioned as a fresh open would be: switching to 'w' truncates the
+    data, switching to 'a' seeks to the end and switching to 'r' flushes.
 
     """
-    if self.mode != mode:
-      f = self.__class__(self.name, self._key, mode)
-      self.close()
-      return f
+    if self._mode == mode:
+      return self
+    self.commit()
+    if "+" in self.mode:
+      if mode == "w":
+        self.seek(0)
+        self.truncate()
+      elif mode == "a":
+        self.seek(0, 2)
+      else:
+        self.flush()
+      self._mode = mode
+      return self
 
-    return self
+    #The new instance must see everything written so far, header included.
+    self.flush()
+    f = self.__class__(self.name, self._key, mode, self.version, self.mapped,
+      self._cache)
+    f.reopens = self.reopens + 1
+    for name, count in self._counts.iteritems():
+      f._counts[name] += count
+    #The key now belongs to f: don't let close() clear it.
+    self._key = None
+    self.close()
+    return f
+
+class AsyncEncryptedFile(object):
+  """EncryptedFile whose reads, writes and their decryption run in threads.
+
+  Every method returns at once with a multiprocessing AsyncResult, so a
+  front end can keep handling input while a large corpus is read and
+  decrypted: it may poll ready() between keystrokes, or pass a callback
+  that is run with the result. read(), write() and seek() run one at a
+  time in the order they were called, since they share the file position;
+  pread()s run alongside them and each other, so they do not wait for
+  earlier write()s to finish.
+
+  Class Variables:
+    WORKERS the default number of threads pread()s run in.
+
+  Member Variables:
+    file the EncryptedFile all I/O goes through.
+    _serial ThreadPool of one thread running read(), write() and seek().
+    _pool ThreadPool running pread()s.
+
+  """
+
+  WORKERS = 4
+
+  def __init__(self, f, workers=WORKERS):
+    """Initialize an AsyncEncryptedFile over an opened EncryptedFile."""
+
+    self.file = f
+    self._serial = ThreadPool(1)
+    self._pool = ThreadPool(workers)
+
+  def read(self, size=-1, callback=None):
+    """Return an AsyncResult of file.read(size)."""
+
+    return self._serial.apply_async(self.file.read, (size,), {}, callback)
+
+  def write(self, byte, callback=None):
+    """Return an AsyncResult of file.write(byte)."""
+
+    return self._serial.apply_async(self.file.write, (byte,), {}, callback)
+
+  def seek(self, offset, whence=0, callback=None):
+    """Return an AsyncResult of file.seek(offset, whence)."""
+
+    return self._serial.apply_async(self.file.seek, (offset, whence), {},
+      callback)
+
+  def pread(self, offset, size, callback=None):
+    """Return an AsyncResult of file.pread(offset, size)."""
+
+    return self._pool.apply_async(self.file.pread, (offset, size), {},
+      callback)
+
+  def close(self):
+    """Wait for all pending work to finish, then close the file."""
+
+    for pool in (self._serial, self._pool):
+      pool.close()
+      pool.join()
+    self.file.close()
 
 class Environment(object):
   """Environment object that keeps tracks of persistent data.
@@ -443,16 +1984,25 @@ class Environment(object):
 
   Class Variables:
     _INDEX name of the index file.
+    _BTREE name of the index file of vaults indexed by a BTreeIndex. A vault
+      has either this file or an _INDEX file.
     _CORPORA name of the corpora file.
+    _MIGRATING suffix of the files migrate() writes before replacing the old.
+    STATS name of the environment variable that, when set, makes setup()
+      have the stats() of the session written to stderr at exit.
 
   Member Variables:
-    _index Index object that keeps an index of topic names.
+    _index Index or BTreeIndex object that keeps an index of topic names.
     _corpora Corpora object that stores corresponding corpora.
+    _cache the PageCache shared by their files, or None.
 
   """
 
   _INDEX = ".index"
+  _BTREE = ".btree"
   _CORPORA = ".corpora"
+  _MIGRATING = ".migrating"
+  STATS = "DMP_STATS"
 
   @staticmethod
   def setup(key):
@@ -460,28 +2010,78 @@ class Environment(object):
 
     Factory for Environment object. Locate the pathes of the Index and Corpora
     files. If these files do no exist in the current directory, they are
-    automatically created. Return an Environment instance.
+    automatically created. Return an Environment instance. The index is a
+    BTreeIndex if the vault has a .btree file, and an Index otherwise.
 
     """
     #key = "1%90ji!mk;r=9j{\o2"
-    #Try to open the file in read mode, if it errors, open in write-mode
-    try:
-      i = EncryptedFile(Environment._INDEX, key)
-    except IOError:
-      i = EncryptedFile(Environment._INDEX, key, "w")
+    #Open each file once for both reading and writing, creating it if it
+    #does not exist yet, so switching modes never needs a reopen.
+    #Reads of both files are served from an mmap, and decrypted pages of
+    #seekable files are held in a cache they share.
+    cache = PageCache()
+    if os.path.exists(Environment._BTREE):
+      i = BTreeIndex(EncryptedFile(Environment._BTREE, key, "r+", None, True,
+        cache))
+    else:
+      try:
+        i = EncryptedFile(Environment._INDEX, key, "r+", None, True, cache)
+      except IOError:
+        i = EncryptedFile(Environment._INDEX, key, "w+", None, True, cache)
+      i = Index(i)
     try:
-      c = EncryptedFile(Environment._CORPORA, key)
+      c = EncryptedFile(Environment._CORPORA, key, "r+", None, True, cache)
     except IOError:
-      c = EncryptedFile(Environment._CORPORA, key, "w")
+      c = EncryptedFile(Environment._CORPORA, key, "w+", None, True, cache)
 
     key = None
-    return Environment(Index(i), Corpora(c))
+    env = Environment(i, Corpora(c), cache)
+    if os.environ.get(Environment.STATS):
+      atexit.register(env.dumpStats)
+    return env
 
-  def __init__(self, index, corpora):
-    """Initialize new Environment given Index and Corpora objects."""
+  @staticmethod
+  def migrate(key, version, btree=False):
+    """Rewrite the index and corpora files in the given format version.
+
+    Every topic is read from the files in the current directory and written
+    to new files of the given version, which then replace the old ones. The
+    corpora are written in the order of the index, so the new .corpora has
+    no space left unused. The key stays the same. The new index is a
+    BTreeIndex if btree is True, and an Index otherwise.
+
+    """
+    old = Environment.setup(key)
+    name = Environment._BTREE if btree else Environment._INDEX
+    i = EncryptedFile(name + Environment._MIGRATING, key, "w+", version, True)
+    new = Environment(BTreeIndex(i) if btree else Index(i),
+      Corpora(EncryptedFile(Environment._CORPORA + Environment._MIGRATING, key,
+        "w+", version, True)))
+    key = None
+    topics = []
+    for t in old.index.entries:
+      n = NewTopic(t.cleanName(), old.corpora.getCorpus(t))
+      #Keep the padding of the name as it was.
+      n.name = t.name
+      topics.append(n)
+    new.insertEntries(topics)
+    files = old.index.files()
+    old.close()
+    new.close()
+    for n in (name, Environment._CORPORA):
+      os.rename(n + Environment._MIGRATING, n)
+    #The new index holds every entry of the old index files.
+    for n in files:
+      if n != name:
+        os.remove(n)
+
+  def __init__(self, index, corpora, cache=None):
+    """Initialize new Environment given Index and Corpora objects, and the
+    PageCache of their files if they share one."""
 
     self._index = index
     self._corpora = corpora
+    self._cache = cache
 
   def insertEntries(self, newEntries):
     """Given an iterable object over NewTopics, write them to disk.
@@ -508,6 +2108,22 @@ class Environment(object):
     self._index.close()
     self._corpora.close()
 
+  def stats(self):
+    """Return a dictionary of the stats() of the Index, the Corpora and
+    their PageCache."""
+
+    stats = {"index": self._index.stats(), "corpora": self._corpora.stats()}
+    if self._cache is not None:
+      stats["cache"] = self._cache.stats()
+    return stats
+
+  def dumpStats(self, out=sys.stderr):
+    """Write stats() as one line per counter."""
+
+    for part, counts in sorted(self.stats().iteritems()):
+      for name, count in sorted(counts.iteritems()):
+        out.write("{0}.{1} {2}\n".format(part, name, count))
+
   @property
   def index(self):
     """Return the Index stored by the Environment."""
@@ -520,6 +2136,26 @@ class Environment(object):
 
     return self._corpora
 
+def mergeTopics(lists):
+  """Merge sorted lists of FindTopics into one sorted list.
+
+  FindTopics with equal padded names keep the order of the lists they come
+  from. A FindTopic found in several lists with the same name, offset and
+  endset is only kept once.
+
+  """
+  merged = []
+  last, seen = None, set()
+  for name, _, _, topic in heapq.merge(*[[(t.name, r, j, t) \
+      for j, t in enumerate(l)] for r, l in enumerate(lists)]):
+    entry = (name, topic.offset, topic.endset)
+    if name != last:
+      last, seen = name, set()
+    if entry not in seen:
+      seen.add(entry)
+      merged.append(topic)
+  return merged
+
 def search(query, body, left=0, right=-1):
   """conduct binary search on tuple of FindTopic objects."""
   if right == -1:
@@ -546,3 +2182,16 @@ def search(query, body, left=0, right=-1):
     return search(query, body, mid+1, right)
   else:
     return search(query, body, left, mid)
+
+if __name__ == "__main__":
+  #Migrate the vault in the current directory to the format given by name,
+  #indexed by a flat, sorted file or by a B+-tree. Backends only meant for
+  #benchmarks are not offered.
+  names = [xor.BACKENDS[i].NAME for i in sorted(xor.BACKENDS)
+    if not xor.BACKENDS[i].BENCHMARK]
+  if not 2 <= len(sys.argv) <= 3 or sys.argv[1] not in names or \
+      sys.argv[2:] not in ([], ["flat"], ["btree"]):
+    sys.exit("usage: {0} {{{1}}} [flat|btree]".format(sys.argv[0],
+      ",".join(names)))
+  Environment.migrate(getpass.getpass(), xor.backend(sys.argv[1]).ID,
+    sys.argv[2:] == ["btree"])
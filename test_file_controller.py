@@ -0,0 +1,496 @@
+"""Tests for file_controller.py.
+
+Every test runs in a temporary directory of its own, since vaults live in
+the current directory.
+"""
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import xor
+from file_controller import AsyncEncryptedFile, BTreeIndex, Corpora, \
+  EncryptedFile, EntryStore, Environment, FindTopic, Index, NewTopic, \
+  PageCache, mergeTopics
+
+KEY = "1%90ji!mk;r=9j{o2"
+
+def topics(names, offset=0):
+  """Return NewTopics of the given names, sorted, with made up offsets."""
+
+  new = []
+  for i, name in enumerate(names):
+    topic = NewTopic(name, "corpus")
+    topic.setOffset(offset + i)
+    new.append(topic)
+  return sorted(new)
+
+def raw(name, fill):
+  """Return name padded with fill the way an .index file holds it."""
+
+  return (name + FindTopic.NULL).ljust(Index._NAME_LENGTH, fill)
+
+class VaultTestCase(unittest.TestCase):
+  """Run each test in a fresh, empty current directory."""
+
+  def setUp(self):
+    self._cwd = os.getcwd()
+    self._dir = tempfile.mkdtemp()
+    os.chdir(self._dir)
+
+  def tearDown(self):
+    os.chdir(self._cwd)
+    shutil.rmtree(self._dir)
+
+class HeaderTest(VaultTestCase):
+  """EncryptedFile._openHeader() format detection."""
+
+  def testEmptyFileGetsHeader(self):
+    open("f", "wb").close()
+    f = EncryptedFile("f", KEY, "r+", EncryptedFile.CHUNKED)
+    self.assertEqual(f.version, EncryptedFile.CHUNKED)
+    f.close()
+    with open("f", "rb") as raw:
+      self.assertEqual(raw.read(), EncryptedFile._MAGIC + \
+        chr(EncryptedFile.CHUNKED))
+
+  def testVersionedHeaderIsDetected(self):
+    for version in sorted(xor.BACKENDS):
+      if version == EncryptedFile.LEGACY:
+        continue
+      f = EncryptedFile("f", KEY, "w", version)
+      f.write("plaintext")
+      f.close()
+      #The version given to an existing file is ignored.
+      f = EncryptedFile("f", KEY, "r", EncryptedFile.LEGACY)
+      self.assertEqual(f.version, version)
+      self.assertEqual(f.tell(), 0)
+      self.assertEqual(f.read(9), "plaintext")
+      f.close()
+
+  def testLegacyFileHasNoHeader(self):
+    f = EncryptedFile("f", KEY, "w", EncryptedFile.LEGACY)
+    f.write("plaintext")
+    f.close()
+    with open("f", "rb") as raw:
+      self.assertEqual(raw.read(), xor.cipher("plaintext", KEY))
+    f = EncryptedFile("f", KEY, "r", EncryptedFile.CHUNKED)
+    self.assertEqual(f.version, EncryptedFile.LEGACY)
+    self.assertEqual(f.read(9), "plaintext")
+    f.close()
+
+  def testUnknownHeaderIsLegacy(self):
+    for head in (EncryptedFile._MAGIC + chr(EncryptedFile.LEGACY),
+        EncryptedFile._MAGIC + chr(max(xor.BACKENDS) + 1), "DM", "xDMP\x01"):
+      with open("f", "wb") as raw:
+        raw.write(head)
+      f = EncryptedFile("f", KEY, "r")
+      self.assertEqual(f.version, EncryptedFile.LEGACY, repr(head))
+      f.close()
+
+class ReopenTest(VaultTestCase):
+  """Switching the mode of '+' handles must never reopen them."""
+
+  def testModeSwitchesKeepHandle(self):
+    corpora = Corpora(EncryptedFile("c", KEY, "w+"))
+    index = Index(EncryptedFile("i", KEY, "w+"), False)
+    for i in xrange(5):
+      corpora._setAppend()
+      corpora._filestream.write("corpus{0}".format(i))
+      corpora._setRead()
+      corpora._filestream.seek(0)
+      self.assertEqual(corpora._filestream.read(7 * (i + 1)),
+        "".join("corpus{0}".format(j) for j in xrange(i + 1)))
+      index._setWrite()
+      index._filestream.write("entry{0}".format(i))
+      index._setRead()
+      index._filestream.seek(0)
+      #'w' truncates: only the last entry is left.
+      self.assertEqual(index._filestream.read(), "entry{0}".format(i))
+    self.assertEqual(corpora._filestream.reopens, 0)
+    self.assertEqual(index._filestream.reopens, 0)
+    corpora.close()
+    index.close()
+
+  def testEnvironmentNeverReopens(self):
+    for i in xrange(3):
+      env = Environment.setup(KEY)
+      env.insertEntries([NewTopic("topic{0}".format(i),
+        "corpus{0}".format(i))])
+      for topic in env.index.entries:
+        self.assertEqual(env.corpora.getCorpus(topic),
+          "corpus" + topic.cleanName()[len("topic"):])
+      stats = env.stats()
+      self.assertEqual(stats["index"]["reopens"], 0)
+      self.assertEqual(stats["corpora"]["reopens"], 0)
+      env.close()
+
+class AsyncEncryptedFileTest(VaultTestCase):
+  """AsyncEncryptedFile must keep serial I/O in order and finish it all."""
+
+  def testPreadsAlongsideSerialIO(self):
+    f = EncryptedFile("f", KEY, "w+", EncryptedFile.CHUNKED)
+    records = ["record{0:04}".format(i) for i in xrange(400)]
+    f.write("".join(records))
+    af = AsyncEncryptedFile(f)
+    order = []
+    preads = [af.pread(i * 10, 10) for i in xrange(len(records))]
+    writes = [af.write(str(i) * 10, lambda n, i=i: order.append(i)) \
+      for i in xrange(10)]
+    seek = af.seek(len(records) * 10)
+    read = af.read(100)
+    self.assertEqual([r.get(5) for r in preads], records)
+    self.assertEqual([w.get(5) for w in writes], [10] * 10)
+    self.assertEqual(seek.get(5), len(records) * 10)
+    self.assertEqual(read.get(5), "".join(str(i) * 10 for i in xrange(10)))
+    self.assertEqual(order, range(10))
+    af.close()
+
+  def testPreadsAlongsideAppendsToMappedFile(self):
+    #Environment opens vault files mapped and cached.
+    expected = "".join(chr(ord("A") + i % 26) * 100 for i in xrange(50))
+    for trial in xrange(40):
+      f = EncryptedFile("f", KEY, "w+", EncryptedFile.CHUNKED, True,
+        PageCache())
+      af = AsyncEncryptedFile(f)
+      results = []
+      for i in xrange(50):
+        results.append(af.write(expected[i*100:(i+1)*100]))
+        results += [af.pread(j * 37, 50) for j in xrange(4)]
+      af.close()
+      for r in results:
+        r.get(5)
+      f = EncryptedFile("f", KEY, "r")
+      self.assertEqual(f.read(), expected)
+      f.close()
+
+  def testCloseWaitsForQueuedWork(self):
+    f = EncryptedFile("f", KEY, "w+", EncryptedFile.CHUNKED)
+    write = f.write
+    def slowWrite(byte):
+      time.sleep(0.05)
+      return write(byte)
+    f.write = slowWrite
+    af = AsyncEncryptedFile(f)
+    results = [af.write("chunk{0}".format(i)) for i in xrange(5)]
+    results.append(af.pread(0, 6))
+    af.close()
+    self.assertTrue(f.closed)
+    self.assertTrue(all(r.ready() and r.successful() for r in results))
+    f = EncryptedFile("f", KEY, "r")
+    self.assertEqual(f.read(),
+      "".join("chunk{0}".format(i) for i in xrange(5)))
+    f.close()
+
+class PageCacheTest(VaultTestCase):
+  """Cached pages must never outlive the data they were read from."""
+
+  def testCommitDropsPages(self):
+    cache = PageCache()
+    f = EncryptedFile("f", KEY, "w+", EncryptedFile.CHUNKED, False, cache)
+    f.write("A" * 10000)
+    f.seek(0)
+    f.bufferWrites()
+    f.write("B" * 100)
+    #Buffered writes are not seen, and the page read is cached.
+    self.assertEqual(f.pread(0, 5), "AAAAA")
+    self.assertEqual(len(cache), 1)
+    f.commit()
+    self.assertEqual(f.pread(0, 5), "BBBBB")
+    f.seek(0)
+    self.assertEqual(f.read(5), "BBBBB")
+    f.close()
+
+  def testMissesReadMapping(self):
+    cache = PageCache()
+    f = EncryptedFile("f", KEY, "w+", EncryptedFile.CHUNKED, True, cache)
+    f.write("A" * 10000)
+    self.assertEqual(f.pread(5000, 5), "AAAAA")
+    #pread() maps the file without making the mmap that carries the file
+    #position, which writes would then take their offset from.
+    self.assertIsNotNone(f._pmap)
+    self.assertIsNone(f._map)
+    self.assertEqual(f.tell(), 10000)
+    f.write("B" * 10000)
+    self.assertIsNone(f._pmap)
+    self.assertEqual(f.pread(9998, 4), "AABB")
+    self.assertEqual(f.pread(19996, 8), "BBBB")
+    f.seek(0)
+    self.assertEqual(f.read(), "A" * 10000 + "B" * 10000)
+    f.close()
+
+  def testTableBypassesCache(self):
+    cache = PageCache()
+    index = Index(EncryptedFile(".index", KEY, "w+", EncryptedFile.CHUNKED,
+      False, cache), False)
+    names = ["a{0:04}".format(i) for i in xrange(1000)]
+    index.insertEntries(topics(names))
+    reads = index.stats()["reads"]
+    self.assertEqual([t.cleanName() for t in index.entries], names)
+    self.assertEqual(index.stats()["reads"], reads + 1)
+    self.assertEqual(len(cache), 0)
+    index.close()
+
+  def testDropDuringLoad(self):
+    cache = PageCache()
+    page = "x" * PageCache.PAGE_SIZE
+    def load():
+      cache.drop("f")
+      return page
+    self.assertEqual(cache.get("f", 0, load), page)
+    self.assertEqual(len(cache), 0)
+    #Drops of other files don't matter.
+    def loadOther():
+      cache.drop("g")
+      return page
+    self.assertEqual(cache.get("f", 0, loadOther), page)
+    self.assertEqual(len(cache), 1)
+    self.assertEqual(cache.get("f", 0, None), page)
+    self.assertEqual(cache.hits, 1)
+
+class IndexSegmentTest(VaultTestCase):
+  """The delta segments of a log-structured Index and their compaction."""
+
+  def openIndex(self, mode="r+", cache=None):
+    return Index(EncryptedFile(".index", KEY, mode, EncryptedFile.CHUNKED,
+      True, cache))
+
+  def assertEntries(self, index, names):
+    names = sorted(names)
+    self.assertEqual(len(index), len(names))
+    self.assertEqual([t.cleanName() for t in index.entries], names)
+    for name in names:
+      self.assertEqual(index.lookup(name).cleanName(), name)
+    self.assertIsNone(index.lookup("missing"))
+    self.assertEqual([t.cleanName() for t in index.prefixRange("b")],
+      [n for n in names if n.startswith("b")])
+
+  def testSegmentsAreDiscovered(self):
+    names = ["a{0:02}".format(i) for i in xrange(40)]
+    index = self.openIndex("w+")
+    index.insertEntries(topics(names))
+    for i in xrange(2):
+      index.insertEntries(topics(["b{0}".format(i)]))
+    #Inserting nothing writes no segment.
+    index.insertEntries([])
+    self.assertEqual(index.segmentNames(), [".index.1", ".index.2"])
+    index.close()
+    index = self.openIndex()
+    self.assertEqual(index.segmentNames(), [".index.1", ".index.2"])
+    self.assertEqual(index.files(), [".index", ".index.1", ".index.2"])
+    self.assertEntries(index, names + ["b0", "b1"])
+    index.close()
+    #An Index that keeps no segments doesn't look for them.
+    index = Index(EncryptedFile(".index", KEY, "r+"), False)
+    self.assertEqual(index.segmentNames(), [])
+    self.assertEqual(len(index), 40)
+    index.close()
+
+  def testCrowdedThresholds(self):
+    index = self.openIndex("w+")
+    index.insertEntries(topics(["a{0:02}".format(i) for i in xrange(40)]))
+    #Don't let the compaction insertEntries() starts change the segments.
+    index.compact = lambda: None
+    for i in xrange(Index._MAX_SEGMENTS):
+      index.insertEntries(topics(["b{0}".format(i)]))
+      self.assertFalse(index._crowded())
+    index.insertEntries(topics(["c"]))
+    self.assertTrue(index._crowded())
+    self.assertEqual(len(index.segmentNames()), Index._MAX_SEGMENTS + 1)
+    index.close()
+    for n in index.files():
+      os.remove(n)
+
+    index = self.openIndex("w+")
+    index.insertEntries(topics(["a{0:02}".format(i) for i in xrange(40)]))
+    index.compact = lambda: None
+    limit = int(40 * Index._SEGMENT_RATIO)
+    index.insertEntries(topics(["b{0:02}".format(i) for i in xrange(limit)]))
+    self.assertFalse(index._crowded())
+    index.insertEntries(topics(["c"]))
+    self.assertTrue(index._crowded())
+    index.close()
+
+  def testMergeDropsDuplicates(self):
+    a, b, c = raw("a", "x"), raw("b", "x"), raw("a", "y")
+    old = EntryStore(a + b, [0, 10], [10, 20])
+    new = EntryStore(a + c, [0, 30], [10, 40])
+    merged = EntryStore.merge([new, old])
+    self.assertEqual([(t.name, t.offset) for t in merged],
+      [(a, 0), (c, 30), (b, 10)])
+    #Entries with equal names but different offsets are all kept, in the
+    #order of the stores.
+    other = EntryStore(a, [50], [60])
+    merged = EntryStore.merge([other, old])
+    self.assertEqual([(t.name, t.offset) for t in merged],
+      [(a, 50), (a, 0), (b, 10)])
+    merged = mergeTopics([list(other), list(new), list(old)])
+    self.assertEqual([(t.name, t.offset) for t in merged],
+      [(a, 50), (a, 0), (c, 30), (b, 10)])
+
+  def testStatsCountSegments(self):
+    index = self.openIndex("w+")
+    index.insertEntries(topics(["a{0:02}".format(i) for i in xrange(40)]))
+    for i in xrange(2):
+      index.insertEntries(topics(["b{0}".format(i)]))
+    stats = index.stats()
+    self.assertEqual(stats["segments"], 2)
+    self.assertEqual(stats["entriesWritten"], 42)
+    self.assertGreaterEqual(stats["bytesWritten"], 42 * Index._ENTRY_LENGTH)
+    self.assertGreater(stats["writes"], index._filestream.stats()["writes"])
+    index.compact()
+    after = index.stats()
+    self.assertEqual(after["segments"], 0)
+    self.assertEqual(after["compactions"], 1)
+    for name in ("writes", "bytesWritten", "entriesWritten"):
+      self.assertGreater(after[name], stats[name])
+    index.close()
+
+  def testCloseJoinsCompaction(self):
+    index = self.openIndex("w+")
+    index.insertEntries(topics(["a{0:02}".format(i) for i in xrange(40)]))
+    compact = index.compact
+    def slowCompact():
+      time.sleep(0.2)
+      compact()
+    index.compact = slowCompact
+    index.insertEntries(topics(["b{0:02}".format(i) for i in xrange(20)]))
+    compactor = index._compactor
+    self.assertIsNotNone(compactor)
+    index.close()
+    self.assertFalse(compactor.is_alive())
+    self.assertIsNone(index._compactor)
+    self.assertEqual(sorted(os.listdir(".")), [".index"])
+    index = self.openIndex()
+    self.assertEqual(len(index), 60)
+    index.close()
+
+  def testCompactLeavesIndexUnlocked(self):
+    names = ["a{0:02}".format(i) for i in xrange(40)] + ["b0"]
+    index = self.openIndex("w+")
+    index.insertEntries(topics(names[:-1]))
+    index.insertEntries(topics(names[-1:], 40))
+    started, resume = threading.Event(), threading.Event()
+    rewrite = Index._rewrite
+    def slowRewrite(this, newEntries):
+      if this._filestream.name.endswith(Index._COMPACTING):
+        started.set()
+        resume.wait(5)
+      rewrite(this, newEntries)
+    Index._rewrite = slowRewrite
+    self.addCleanup(setattr, Index, "_rewrite", rewrite)
+    compactor = threading.Thread(target=index.compact)
+    compactor.start()
+    started.wait(5)
+    #Reads and inserts go on while the merged file is written.
+    self.assertEqual(index.lookup("b0").cleanName(), "b0")
+    index.insertEntries(topics(["b1"], 41))
+    names.append("b1")
+    self.assertTrue(compactor.is_alive())
+    resume.set()
+    compactor.join()
+    #Only the segments there when compact() started are merged.
+    self.assertEqual(index.segmentNames(), [".index.2"])
+    self.assertEntries(index, names)
+    index.close()
+    index = self.openIndex()
+    self.assertEqual(index.segmentNames(), [".index.2"])
+    self.assertEntries(index, names)
+    index.insertEntries(topics(["b2"], 42))
+    self.assertEqual(index.segmentNames(), [".index.2", ".index.3"])
+    index.close()
+
+  def testCycle(self):
+    cache = PageCache()
+    index = self.openIndex("w+", cache)
+    names = []
+    for i in xrange(5):
+      #The first batch goes to .index, the others to small segments.
+      batch = ["a{0}{1:03}".format(i, j) for j in xrange(10 if i else 400)] \
+        + ["b{0}".format(i)]
+      index.insertEntries(topics(batch, len(names)))
+      names += batch
+      self.assertEntries(index, names)
+    self.assertEqual(len(index.segmentNames()), 4)
+    index.compact()
+    self.assertEqual(index.segmentNames(), [])
+    self.assertEqual(sorted(os.listdir(".")), [".index"])
+    self.assertEntries(index, names)
+    index.insertEntries(topics(["b9"], len(names)))
+    names.append("b9")
+    self.assertEntries(index, names)
+    index.close()
+    index = self.openIndex("r+", cache)
+    self.assertEqual(index.segmentNames(), [".index.1"])
+    self.assertEntries(index, names)
+    index.close()
+
+  def testMigrateRemovesSegments(self):
+    env = Environment.setup(KEY)
+    #Keep the segments for migrate() to remove.
+    env.index.compact = lambda: None
+    for i in xrange(3):
+      env.insertEntries(topics(["topic{0}".format(i)]))
+    self.assertEqual(len(env.index.segmentNames()), 2)
+    env.close()
+    Environment.migrate(KEY, xor.backend("chunked").ID)
+    self.assertEqual(sorted(os.listdir(".")), [".corpora", ".index"])
+    env = Environment.setup(KEY)
+    self.assertEqual([t.cleanName() for t in env.index.entries],
+      ["topic0", "topic1", "topic2"])
+    for topic in env.index.entries:
+      self.assertEqual(env.corpora.getCorpus(topic), "corpus")
+    env.close()
+
+class BTreeIndexTest(VaultTestCase):
+  """A BTreeIndex large enough for its internal pages to split."""
+
+  #More entries than a root over full leaves holds.
+  COUNT = 3 * BTreeIndex.LEAF_CAPACITY * BTreeIndex.INTERNAL_CAPACITY
+  BATCHES = 4
+
+  def depth(self, index):
+    node, depth = index._node(index._root), 1
+    while not node.leaf:
+      node, depth = index._node(node.children[0]), depth + 1
+    return depth
+
+  def checkTree(self, version):
+    names = ["t{0:05}".format(i) for i in xrange(self.COUNT)]
+    random.shuffle(names)
+    index = BTreeIndex(EncryptedFile(".btree", KEY, "w+", version, True))
+    new = []
+    step = len(names) // self.BATCHES + 1
+    for i in xrange(0, len(names), step):
+      batch = topics(names[i:i+step], len(new))
+      index.insertEntries(batch)
+      new += batch
+    index.close()
+    index = BTreeIndex(EncryptedFile(".btree", KEY, "r+", None, True))
+    self.assertGreaterEqual(self.depth(index), 3)
+    expected = sorted(new)
+    self.assertEqual(len(index), self.COUNT)
+    self.assertEqual([(t.name, t.offset, t.endset) for t in index.entries],
+      [(t.name, t.offset, t.endset) for t in expected])
+    for topic in random.sample(expected, 200):
+      found = index.lookup(topic.printName)
+      self.assertEqual((found.name, found.offset),
+        (topic.name, topic.offset))
+    self.assertIsNone(index.lookup("t"))
+    self.assertIsNone(index.lookup("u"))
+    for prefix in ("t123", "t0", "t99999", "u"):
+      self.assertEqual([t.name for t in index.prefixRange(prefix)],
+        [t.name for t in expected if t.printName.startswith(prefix)])
+    index.close()
+
+  def testXor(self):
+    self.checkTree(xor.backend("xor").ID)
+
+  def testChunked(self):
+    self.checkTree(xor.backend("chunked").ID)
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,36 @@
+"""Tests for xor.py that its doctests can't express."""
+import os
+import unittest
+
+import xor
+from benchmark import peakGrowth
+
+class CipherMemoryTest(unittest.TestCase):
+  """cipher() must take memory linear in the size of its input alone."""
+
+  KEY = "reallylongkey" * 5
+  SMALL = 1 << 22
+  LARGE = 1 << 24
+  #Allowed growth of the peak per byte of input from SMALL to LARGE.
+  SLACK = 1.5
+
+  def testPeakGrowsLinearly(self):
+    small = os.urandom(self.SMALL)
+    large = os.urandom(self.LARGE)
+    smallPeak = peakGrowth(lambda: xor.cipher(small, self.KEY))
+    largePeak = peakGrowth(lambda: xor.cipher(large, self.KEY))
+    self.assertGreater(smallPeak, 0)
+    self.assertLess(largePeak,
+      smallPeak * self.SLACK * self.LARGE // self.SMALL)
+    #Replicating the key over the text would take len(KEY) times its size.
+    self.assertLess(largePeak * 1024, len(self.KEY) * self.LARGE // 4)
+
+  def testPeakIndependentOfKey(self):
+    txt = os.urandom(self.SMALL)
+    shortPeak = peakGrowth(lambda: xor.cipher(txt, os.urandom(4)))
+    longPeak = peakGrowth(lambda: xor.cipher(txt, os.urandom(256)))
+    self.assertGreater(shortPeak, 0)
+    self.assertLess(longPeak, shortPeak * self.SLACK)
+
+if __name__ == "__main__":
+  unittest.main()
@@ -1,6 +1,14 @@
+import abc
 import sys
+from binascii import hexlify, unhexlify
+from collections import OrderedDict
+from multiprocessing import Pool, cpu_count
+from os import urandom
+from threading import Lock
 p = "plaintext"
 k = "reallylongkey"
+CHUNK = 4096
+PARALLEL = 1 << 22
 def main():
   sys.stdout.write(cipher(sys.argv[1],sys.argv[2]))
 
@@ -26,12 +34,316 @@ def cipher(txt,k):
   ngkeyreal|lylongkey
   lylongkey|
   
+  Every sxor() pass above only depends on the key and the length of
+  the plaintext, so the passes are collapsed into one period() of the
+  composite keystream and applied with a single sxor(). Nothing longer
+  than the key is derived, so memory stays O(len(txt)+len(k)).
+
   >>> p = "plaintext"
   >>> k = "reallylongkey"
   >>> cipher(p,k) == (cipher(p[:-1],k) + cipher(p[-1],k))
   False
+  >>> cipher(p,k) == lcipher(p,k)
+  True
+  >>> cipher(p*5,k) == lcipher(p*5,k)
+  True
+  """
+  return sxor(txt,period(k,len(txt)))
+
+def keystream(k,length):
+  """Return the composite keystream cipher() applies to a plaintext of
+  the given length.
+
+  >>> k = "reallylongkey"
+  >>> keystream(k,9) == lcipher("\\x00"*9,k)
+  True
+  >>> keystream(k,40) == lcipher("\\x00"*40,k)
+  True
+  >>> keystream(k,1)
+  '\\x00'
+  """
+  w = period(k,length)
+  return (w * (length//len(w) + 1))[:length] if w else w
+
+def period(k,length):
+  """Return one period of the composite keystream for the given length.
+
+  Pass i of lcipher() XORs byte j of the text with k[(i-1+j) % len(k)],
+  so byte j ends up XORed with the run k[j], k[j+1], ... k[j+length-2]
+  of the endlessly repeated key. With running XORs pre[] over one copy
+  of the key, such a run only depends on j % len(k): the composite
+  keystream repeats with the period of the key. Window offsets are
+  taken modulo len(k) and at most len(k) bytes are ever built.
+
+  >>> k = "reallylongkey"
+  >>> len(period(k,10**7)) == len(k)
+  True
+  >>> period(k,4) == keystream(k,4)
+  True
+  """
+  if isinstance(k,Key):
+    return k.period(length)
+  if length < 2:
+    return "\x00"*length
+  if not k:
+    raise ValueError("cannot derive a keystream from an empty key")
+  z = len(k)
+  pre = bytearray(z+1)
+  for i in xrange(z):
+    pre[i+1] = pre[i] ^ ord(k[i])
+  whole = pre[z]
+  w = bytearray(min(z,length))
+  for j in xrange(len(w)):
+    end = j + length - 1
+    w[j] = pre[j] ^ pre[end % z] ^ (whole if (end//z) % 2 else 0)
+  return str(w)
+
+def cipher_many(buffers,k):
+  """Return [cipher(b,k) for b in buffers], computed in one sxor().
+
+  Each distinct buffer length derives its keystream once, the tiled
+  keystreams and the buffers are joined, XORed in a single pass and split
+  back up.
+
+  >>> k = "reallylongkey"
+  >>> fields = ["plaintext","offset","endset","x","","endset"]
+  >>> cipher_many(fields,k) == [cipher(f,k) for f in fields]
+  True
+  """
+  periods = {}
+  streams = []
+  for b in buffers:
+    n = len(b)
+    if n not in periods:
+      periods[n] = period(k,n) if n else ""
+    w = periods[n]
+    streams.append((w * (n//len(w) + 1))[:n] if n else "")
+  out = sxor("".join(buffers),"".join(streams))
+  result = []
+  i = 0
+  for b in buffers:
+    result.append(out[i:i+len(b)])
+    i += len(b)
+  return result
+
+def cipher_records(txt,k,widths):
+  """Return cipher_many() of consecutive records of fields, as one string.
+
+  txt holds whole records, each made of fields of the given widths, in
+  order. Every record XORs with the same keystreams, so they are derived
+  once for a single record and sxor() tiles them over all of txt.
+
+  >>> k = "reallylongkey"
+  >>> fields = ["plaintext","offset","endset"] * 3
+  >>> cipher_records("".join(fields),k,(9,6,6)) == "".join(cipher_many(fields,k))
+  True
+  """
+  return sxor(txt,"".join(keystream(k,w) for w in widths)) if txt else ""
+
+def pcipher(txt,k,pool=None,threshold=PARALLEL):
+  """Parallel cipher(): split large plaintexts across a process pool.
+
+  Plaintexts shorter than threshold bytes are enciphered in-process.
+  Larger ones are cut into pieces that are a multiple of the keystream
+  period long, so every piece starts at the same keystream offset and can
+  be tiled and XORed by a separate process. An existing
+  multiprocessing.Pool may be passed in; otherwise one is created and
+  torn down for this call.
+
+  >>> p = "plaintext"*1000
+  >>> k = "reallylongkey"
+  >>> pcipher(p,k,threshold=0) == cipher(p,k)
+  True
+  >>> pcipher(p,k) == cipher(p,k)
+  True
+  """
+  n = len(txt)
+  if n < max(threshold,2):
+    return cipher(txt,k)
+  w = period(k,n)
+  owned = pool is None
+  if owned:
+    pool = Pool()
+  step = len(w) * max(1, n // (4*cpu_count()) // len(w))
+  try:
+    return "".join(pool.map(_psxor,[(txt[i:i+step],w) \
+      for i in xrange(0,n,step)]))
+  finally:
+    if owned:
+      pool.close()
+      pool.join()
+
+def _psxor(args):
+  """sxor() for a (plaintext,key) tuple, run in a pcipher() worker."""
+  return sxor(*args)
+
+def scipher(txt,k,pos,chunk=CHUNK):
+  """Seekable cipher: txt is the plaintext found at offset pos of a stream.
+
+  Unlike cipher(), this is not dependant upon the length of the
+  plaintext. The stream is cut into chunks of the given size and chunk c
+  is XORed with the keystream cipher() would use for a plaintext of
+  chunk+c bytes, restarted at the chunk boundary. Any byte range can be
+  enciphered or deciphered on its own.
+
+  >>> p = "plaintext"*1000
+  >>> k = "reallylongkey"
+  >>> s = scipher(p,k,0,64)
+  >>> s[100:5000] == scipher(p[100:5000],k,100,64)
+  True
+  >>> scipher(s,k,0,64) == p
+  True
+  >>> s[:64] == cipher(p[:64],k)
+  True
+  """
+  pieces = []
+  i = 0
+  while i < len(txt):
+    c,o = divmod(pos+i,chunk)
+    n = min(chunk-o,len(txt)-i)
+    w = period(k,chunk+c)
+    o %= len(w)
+    pieces.append(sxor(txt[i:i+n],w[o:]+w[:o]))
+    i += n
+  return "".join(pieces)
+
+class KeystreamCache(object):
+  """Least recently used cache of the keystream periods of one key.
+
+  period() only depends on the key and the plaintext length, never on the
+  plaintext itself, so fixed-width fields (such as the name, offset and
+  endset of every .index entry) can share one derivation per length.
+  Periods are cached by length alone: the key itself is never held, which
+  is why a cache belongs to a single key (see Key).
+
+  >>> c = KeystreamCache(2)
+  >>> k = "reallylongkey"
+  >>> c.get(9, lambda: period(k,9)) == period(k,9)
+  True
+  >>> _ = c.get(6, lambda: period(k,6)), c.get(9, lambda: period(k,9))
+  >>> c.derivations, len(c)
+  (2, 2)
+  >>> _ = c.get(5, lambda: period(k,5))
+  >>> c.derivations, len(c)
+  (3, 2)
+
+  Class Variables:
+    SIZE the default number of periods to hold.
+
+  Member Variables:
+    size the maximum number of periods held before the least recently
+      used one is evicted.
+    derivations the number of times a period had to be derived.
+    _periods OrderedDict mapping a length to its period, oldest first.
+    _lock Lock held while _periods is changed, so threads can share a cache.
+
   """
 
+  SIZE = 8
+
+  def __init__(self, size=SIZE):
+    """Initialize an empty cache holding at most size periods."""
+
+    self.size = size
+    self.derivations = 0
+    self._periods = OrderedDict()
+    self._lock = Lock()
+
+  def __len__(self):
+    """Return the number of periods currently held."""
+
+    return len(self._periods)
+
+  def get(self, length, derive):
+    """Return the period cached for length, calling derive() on a miss."""
+
+    with self._lock:
+      w = self._periods.pop(length, None)
+    if w is None:
+      w = derive()
+      self.derivations += 1
+    with self._lock:
+      if length not in self._periods and len(self._periods) >= self.size:
+        self._periods.popitem(last=False)
+      self._periods[length] = w
+    return w
+
+  def clear(self):
+    """Drop every cached period."""
+
+    with self._lock:
+      self._periods.clear()
+
+class Key(object):
+  """Prepared key that the cipher functions consume directly.
+
+  The key is obfuscated in memory by enciphering it with a random access
+  key, and is only deciphered back into plaintext when a keystream period
+  that is not cached yet has to be derived. Any function taking a key k
+  also takes a Key; the periods it uses then come from the Key's cache.
+
+  >>> k = Key("reallylongkey")
+  >>> cipher("plaintext",k) == cipher("plaintext","reallylongkey")
+  True
+  >>> _ = cipher("plaintext",k), cipher_many(["offset","endset"],k)
+  >>> k.derivations
+  2
+  >>> k.plaintext()
+  'reallylongkey'
+
+  Class Variables:
+    ACCESS_LENGTH the size(in bytes) of the random access key.
+
+  Member Variables:
+    _access generated encryption key to encrypt the passed-in key with.
+    _key the key enciphered with _access.
+    _keystreams KeystreamCache of the periods derived from the key, keyed
+      by length.
+
+  """
+
+  ACCESS_LENGTH = 255
+
+  def __init__(self, key, size=KeystreamCache.SIZE):
+    """Prepare the given plaintext key, caching at most size periods."""
+
+    self._access = urandom(self.ACCESS_LENGTH)
+    self._key = cipher(key, self._access)
+    self._keystreams = KeystreamCache(size)
+    key = None
+
+  @property
+  def derivations(self):
+    """Return the number of periods derived from the key so far."""
+
+    return self._keystreams.derivations
+
+  def plaintext(self):
+    """Return the plaintext key."""
+
+    return cipher(self._key, self._access)
+
+  def period(self, length):
+    """Return period() of the key for the given length, cached."""
+
+    return self._keystreams.get(length, \
+      lambda: period(self.plaintext(), length))
+
+  def clear(self):
+    """Drop every cached period and the key itself."""
+
+    self._keystreams.clear()
+    self._key = self._access = None
+
+def lcipher(txt,k):
+  """Legacy cipher(): one sxor() pass per character of the plaintext.
+
+  This is the original O(n^2) implementation, kept as the reference
+  that cipher() must match byte for byte.
+
+  >>> lcipher("plaintext","reallylongkey") == cipher("plaintext","reallylongkey")
+  True
+  """
   k = k * len(txt)#keykeykey
   for i in xrange(1,len(txt)):
     txt = sxor(txt,k[i-1:len(txt)*i])
@@ -41,37 +353,286 @@ def sxor(plaintext,key):
   """cipher that is not input length dependant. It has a
   distributive property on substrings.
 
+  The key is tiled out to the length of the plaintext and both are
+  XORed as single integers, so the whole buffer goes through in one
+  pass rather than one chr() per character.
+
   >>> p = "plaintext"
   >>> k = "reallylongkey"
   >>> sxor(p,k) == (sxor(p[:-1],k) + sxor(p[-1],k))
   False
   >>> sxor(p[:-1],k) == sxor(p,k)[:-1]
   True
+  >>> sxor(p*3,k) == "".join(chr(ord(a)^ord(b)) for a,b in zip(p*3,k*3))
+  True
+  >>> sxor("",k)
+  ''
   
   """
-  i,n = 0,0
-  z = len(key)
-  result = ''
-  while i < len(plaintext):
-    if n >=z:
-      n = 0
-    result+=chr(ord(plaintext[i])^ord(key[n]))
-    i,n = i+1,n+1
-  return result
+  n = len(plaintext)
+  if not n:
+    return ''
+  key = (key * (n//len(key) + 1))[:n]#keykeyk
+  x = int(hexlify(plaintext),16) ^ int(hexlify(key),16)
+  return unhexlify("%0*x" % (2*n, x))
+
+def sxor_into(buf,key,key_offset=0):
+  """sxor() a bytearray or writable memoryview, storing the result in it.
+
+  The key is applied as if the buffer started key_offset bytes into it.
+  Return the number of bytes XORed. This is a convenience, not an
+  allocation-free XOR: the tiled key, the hexlified operands, the integers
+  and the result are all built as in sxor(), then copied back into buf.
+
+  >>> p = "plaintext"
+  >>> k = "reallylongkey"
+  >>> b = bytearray(p)
+  >>> sxor_into(b,k)
+  9
+  >>> str(b) == sxor(p,k)
+  True
+  >>> b = bytearray(p*3)
+  >>> _ = sxor_into(memoryview(b)[5:20],k,5)
+  >>> str(b)[5:20] == sxor(p*3,k*3)[5:20]
+  True
+  """
+  n = len(buf)
+  if not n:
+    return 0
+  o = key_offset % len(key)
+  key = key[o:]+key[:o]
+  key = (key * (n//len(key) + 1))[:n]#keykeyk
+  x = int(hexlify(buf),16) ^ int(hexlify(key),16)
+  buf[:] = unhexlify("%0*x" % (2*n, x))
+  return n
+
+def scipher_into(buf,k,pos,chunk=CHUNK):
+  """scipher() a bytearray or writable memoryview found at offset pos of a
+  stream, storing the result in it. Return the number of bytes deciphered.
+  Each chunk is copied as sxor_into() does.
+
+  >>> p = "plaintext"*1000
+  >>> k = "reallylongkey"
+  >>> b = bytearray(scipher(p,k,7,64))
+  >>> scipher_into(memoryview(b),k,7,64)
+  9000
+  >>> str(b) == p
+  True
+  """
+  view = memoryview(buf)
+  i = 0
+  while i < len(view):
+    c,o = divmod(pos+i,chunk)
+    n = min(chunk-o,len(view)-i)
+    i += sxor_into(view[i:i+n],period(k,chunk+c),o)
+  return i
 
 def rcipher(txt,key):
-  origkey = key
-  def reccipher(txt,key):
-    #print txt
-    #print key
-    x = len(txt)
-    if x == len(key):
-      return sxor(txt,key)
-    futurekey = key[x:]
-    if len(futurekey) != x:
-      futurekey = futurekey+origkey
-    return reccipher(sxor(txt,key[:x]),futurekey)
-  return reccipher(txt,key)
+  """Chunked cipher: XOR txt with successive len(txt)-byte slices of the
+  key, refilling the key with a fresh copy whenever what is left of it
+  is not exactly len(txt) long, until it is.
+
+  What is left of the key is always the last l bytes of the key repeated
+  end to end, so it is tracked by its length l alone and the slices are
+  XORed together into one keystream by rkeystream() before touching txt.
+  Only some text lengths ever line up with the key; the others raise
+  ValueError.
+
+  >>> rcipher("plaintext","reallylong") == "plaintext"
+  False
+  >>> rcipher(rcipher("plaintext","reallylong"),"reallylong")
+  'plaintext'
+  """
+  return sxor(txt,rkeystream(key,len(txt)))
+
+def rkeystream(key,length):
+  """Return the keystream rcipher() applies to a text of the given length.
+
+  >>> rkeystream("reallylong",9) == rcipher("\\x00"*9,"reallylong")
+  True
+  >>> rkeystream("reallylongkey",20)
+  Traceback (most recent call last):
+  ...
+  ValueError: key length never lines up with a 20 byte text
+  """
+  z = len(key)
+  l = z
+  ks = "\x00"*length
+  seen = set()
+  while l != length:
+    #A remainder longer than 2*length only ever grows; any other one that
+    #comes back around is a cycle.
+    if l in seen or l > 2*length:
+      raise ValueError("key length never lines up with a %d byte text" \
+        % length)
+    seen.add(l)
+    s = -l % z
+    ks = sxor(ks,key[s:]+key[:s])
+    l = l-length if l-length == length else max(l-length,0)+z
+  s = -l % z
+  return sxor(ks,key[s:]+key[:s])
+
+def rcipher_stream(chunks,key):
+  """Generate rcipher(chunk,key) for every chunk of an iterable.
+
+  Nothing is recursed into and only the keystream of the latest chunk
+  length is kept, so a large file can be streamed through in fixed-size
+  chunks with memory proportional to the chunk and the key.
+
+  >>> list(rcipher_stream(["plain","text!","x"*5],"keyke")) == \
+  [rcipher("plain","keyke"),rcipher("text!","keyke"),rcipher("x"*5,"keyke")]
+  True
+  """
+  length,ks = None,None
+  for chunk in chunks:
+    if len(chunk) != length:
+      length,ks = len(chunk),rkeystream(key,len(chunk))
+    yield sxor(chunk,ks)
+
+class Backend(object):
+  """Cipher backend of an EncryptedFile format.
+
+  A backend enciphers and deciphers the bytes found at a given offset of a
+  file. Backends are registered in BACKENDS under their ID, which is the
+  version byte in the header of every file using them.
+
+  Class Variables:
+    ID the version byte identifying the backend.
+    NAME human-readable name of the backend.
+    SEEKABLE True if any byte range can be deciphered on its own. If False,
+      data must be read back in exactly the sizes it was written in.
+    BENCHMARK True if the backend is only meant for benchmarks, so vaults
+      should never be stored in it.
+
+  """
+
+  __metaclass__ = abc.ABCMeta
+
+  ID = None
+  NAME = None
+  SEEKABLE = False
+  BENCHMARK = False
+
+  @abc.abstractmethod
+  def cipher(self, txt, k, pos):
+    """Encipher or decipher txt found at offset pos with the key k."""
+
+  def cipher_into(self, buf, k, pos):
+    """cipher() a bytearray or writable memoryview, storing the result in
+    it."""
+
+    buf[:] = self.cipher(memoryview(buf).tobytes(), k, pos)
+
+  def cipher_many(self, buffers, k, pos):
+    """cipher() consecutive buffers, each written on its own, from pos on."""
+
+    result = []
+    for b in buffers:
+      result.append(self.cipher(b, k, pos))
+      pos += len(b)
+    return result
+
+  def cipher_records(self, txt, k, pos, widths):
+    """cipher_many() of whole records of fields of the given widths found
+    at offset pos in txt, returned as one string."""
+
+    if self.SEEKABLE:
+      return self.cipher(txt, k, pos)
+    fields = []
+    i = 0
+    while i < len(txt):
+      for w in widths:
+        fields.append(txt[i:i+w])
+        i += w
+    return "".join(self.cipher_many(fields, k, pos))
+
+class XorBackend(Backend):
+  """cipher() of every write as a whole. Files using it have no header."""
+
+  ID = 0
+  NAME = "xor"
+
+  def cipher(self, txt, k, pos):
+    return cipher(txt, k)
+
+  def cipher_into(self, buf, k, pos):
+    if len(buf):
+      sxor_into(buf, period(k, len(buf)))
+
+  def cipher_many(self, buffers, k, pos):
+    return cipher_many(buffers, k)
+
+  def cipher_records(self, txt, k, pos, widths):
+    return cipher_records(txt, k, widths)
+
+class ChunkedBackend(Backend):
+  """scipher() of the stream, seekable in CHUNK sized pieces."""
+
+  ID = 1
+  NAME = "chunked"
+  SEEKABLE = True
+
+  def cipher(self, txt, k, pos):
+    return scipher(txt, k, pos)
+
+  def cipher_into(self, buf, k, pos):
+    scipher_into(buf, k, pos)
+
+  def cipher_many(self, buffers, k, pos):
+    out = scipher("".join(buffers), k, pos)
+    result = []
+    i = 0
+    for b in buffers:
+      result.append(out[i:i+len(b)])
+      i += len(b)
+    return result
+
+class LcipherBackend(Backend):
+  """lcipher() of every write as a whole: the xor format, computed by the
+  original O(n^2) implementation. Only useful for benchmarking."""
+
+  ID = 2
+  NAME = "lcipher"
+  BENCHMARK = True
+
+  def cipher(self, txt, k, pos):
+    return lcipher(txt, k.plaintext() if isinstance(k, Key) else k)
+
+class NullBackend(Backend):
+  """No cipher at all, to benchmark I/O without the cost of encryption.
+
+  >>> NullBackend().cipher("plaintext","reallylongkey",0)
+  'plaintext'
+  """
+
+  ID = 3
+  NAME = "null"
+  SEEKABLE = True
+  BENCHMARK = True
+
+  def cipher(self, txt, k, pos):
+    return txt
+
+  def cipher_into(self, buf, k, pos):
+    pass
+
+BACKENDS = dict((b.ID, b) for b in \
+  (XorBackend(), ChunkedBackend(), LcipherBackend(), NullBackend()))
+
+def backend(name):
+  """Return the registered backend with the given NAME.
+
+  >>> backend("chunked").ID
+  1
+  >>> [BACKENDS[i].NAME for i in sorted(BACKENDS)]
+  ['xor', 'chunked', 'lcipher', 'null']
+  >>> [BACKENDS[i].NAME for i in sorted(BACKENDS) if not BACKENDS[i].BENCHMARK]
+  ['xor', 'chunked']
+  """
+  for b in BACKENDS.itervalues():
+    if b.NAME == name:
+      return b
+  raise KeyError(name)
 
 #if __name__ == '__main__':
 #  main()